@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+
+"""Benchmarks for the functions in htf.py.
+
+Every benchmark runs on synthetic input generated here, so nothing
+needs to be installed but htf.py itself: fonts are read with a stub
+get_characters() backend or with htf.py's own Type 1 reader, never
+with FontForge, and VFtoHTF is only timed if dvilike is installed.
+Each stage is timed at several input sizes, and its peak memory use
+is measured with tracemalloc in a separate run.
+
+Run it as a script: 'python3 benchmark.py --lines 10000 1000000
+--output results.json' runs every benchmark, with map files of 10000
+and 1000000 lines, and writes the results as JSON, which a later run
+can compare itself against with '--compare results.json'.  Run
+'python3 benchmark.py --help' for the other sizes.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import htf
+
+
+# Lines in the styles of pdftex.map: fonts with and without encodings
+# and Postscript code, fonts that are only a TeX name and a glyph
+# file, and comments.
+_map_lines = ('ec-lmr{0} LMRoman{0}-Regular "enclmrec ReEncodeFont" <lm-ec.enc <lmr{0}.pfb\n',
+              'cmr{0} CMR{0} <cmr{0}.pfb\n',
+              'ptmr8r{0} Times-Roman "TeXBase1Encoding ReEncodeFont" <8r.enc <<utmr8a{0}.pfb\n',
+              'tcrm{0} <[ts1-{0}.enc <tcrm{0}.pfb\n',
+              '% Comment {0}\n')
+
+
+def synthetic_map(lines):
+    """Returns a list of lines that look like a map file."""
+    return [_map_lines[i % len(_map_lines)].format(i) for i in range(lines)]
+
+
+def synthetic_characters(seed = 0):
+    """Returns a full 256-position character table like get_characters() does.
+
+    Most positions have code points, some are pictorial, and a few are
+    empty.  Different seeds give different tables.
+    """
+    chars = {}
+    for i in range(256):
+        if (i + seed) % 17 == 0:
+            continue
+        if (i + seed) % 11 == 0:
+            chars[i] = htf.character(-1, 'glyph' + str(i))
+        else:
+            chars[i] = htf.character(0x100 * (seed % 7) + i + 32, 'uni%04X' % (0x100 * (seed % 7) + i + 32))
+    return chars
+
+
+def _stub_characters(font_file, enc_file = None):
+    """A get_characters() backend that doesn't read the font file."""
+    return htf.CharacterTable(synthetic_characters(len(font_file)))
+
+
+htf.character_backends['stub'] = _stub_characters
+
+
+def _encrypt(plain, key = 55665):
+    """eexec-encrypts bytes, the inverse of htf._eexec_decrypt()."""
+    encrypted = bytearray()
+    for byte in plain:
+        cipher = byte ^ (key >> 8)
+        key = ((cipher + key) * 52845 + 22719) & 0xFFFF
+        encrypted.append(cipher)
+    return bytes(encrypted)
+
+
+def synthetic_pfb(glyphs = 256, charstring_length = 200):
+    """Returns the bytes of a Type 1 PFB file with the given number of glyphs."""
+    names = ['g%d' % i for i in range(glyphs)]
+    cleartext = b'%!PS-AdobeFont-1.0: Synthetic 001.000\n/FontName /Synthetic def\n/Encoding 256 array\n'
+    cleartext += b'0 1 255 {1 index exch /.notdef put} for\n'
+    cleartext += b''.join(b'dup %d /%s put\n' % (i, name.encode()) for i, name in enumerate(names[:256]))
+    cleartext += b'readonly def\ncurrentdict end\ncurrentfile eexec\n'
+    private = b'\0\0\0\0dup /Private 8 dict dup begin\n/Subrs 0 array\n'
+    private += b'2 index /CharStrings %d dict dup begin\n' % (glyphs + 1)
+    for name in ['.notdef'] + names:
+        private += b'/%s %d RD %s ND\n' % (name.encode(), charstring_length, bytes(charstring_length))
+    private += b'end\nend\nreadonly put\nnoaccess put\nmark currentfile closefile\n'
+    trailer = b'0' * 512 + b'\ncleartomark\n'
+    segments = ((1, cleartext), (2, _encrypt(private)), (1, trailer))
+    return b''.join(struct.pack('<BBI', 0x80, segment_type, len(data)) + data
+                    for segment_type, data in segments) + b'\x80\x03'
+
+
+def synthetic_vf(packets = 256, fonts = 4):
+    """Returns the bytes of a VF file.
+
+    Each packet moves the reference point, typesets a character from
+    one of the real fonts, sometimes changes fonts, and sometimes
+    typesets a second character, like accented letters built by
+    virtual fonts do.
+    """
+    data = bytearray([247, 202, 9]) + b'synthetic' + bytes(8)
+    for font_num in range(fonts):
+        name = b'real%d' % font_num
+        data += bytes([243, font_num]) + struct.pack('>III', 0, 10 << 20, 10 << 20) + bytes([0, len(name)]) + name
+    for i in range(packets):
+        dvi = bytearray([141, 143, i % 100, 147, 157, 0, 10])
+        if i % 3 == 0:
+            dvi += bytes([171 + i % fonts])
+        dvi += bytes([i % 128]) if i % 2 else bytes([128, i % 256])
+        if i % 5 == 0:
+            dvi += bytes([142, 141, 161, 128, (i + 1) % 256])
+        dvi += bytes([142])
+        if i < 242 and len(dvi) < 242:
+            data += bytes([len(dvi), i]) + bytes(3) + dvi
+        else:
+            data += bytes([242]) + struct.pack('>III', len(dvi), i, 0) + dvi
+    data += bytes([248]) * (4 - len(data) % 4 or 4)
+    return bytes(data)
+
+
+def measure(function, repeat):
+    """Times function() and measures its peak memory use.
+
+    Returns:
+        A dictionary with the shortest and mean times out of repeat
+        calls in seconds and the peak memory allocated during a
+        separate call in bytes.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    # tracemalloc slows everything down, so memory is measured
+    # separately from time.
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'best': min(times), 'mean': sum(times) / len(times), 'peak_memory': peak}
+
+
+def bench_map(lines, repeat):
+    """Times parse_map() and iter_map() on a synthetic map file."""
+    map_file = synthetic_map(lines)
+    if [tuple(font) for font in htf.parse_map(map_file) if font.tex_name] != [tuple(font) for font in htf.iter_map(map_file)]:
+        raise AssertionError("parse_map() and iter_map() don't agree")
+    return {'parse_map': measure(lambda: htf.parse_map(map_file), repeat),
+            'iter_map': measure(lambda: list(htf.iter_map(map_file)), repeat)}
+
+
+def bench_tables(count, repeat):
+    """Times the functions that write .htf files on count character tables."""
+    tables = [synthetic_characters(i) for i in range(count)]
+    compact = [htf.CharacterTable(chars) for chars in tables]
+    names = ['font' + str(i) for i in range(count)]
+    # Typewriter fonts have 'tt1' in their names, which isn't a tag.
+    for tex_name, alias in (('lmtt10-ot1', 'lm-rep-cmrm'), ('cmtt10-ts1', 'tcrm'),
+                            ('lmtt10-t2a', 'larm'), ('ec-lmtt10', None), ('cmtt10', None)):
+        if htf.external_alias(tex_name, io.StringIO()) != alias:
+            raise AssertionError('external_alias() picked the wrong encoding for ' + tex_name)
+
+    def write():
+        for chars, tex_name in zip(tables, names):
+            htf.write_htf(chars, tex_name, io.StringIO())
+
+    def write_compact():
+        for chars, tex_name in zip(compact, names):
+            htf.write_htf(chars, tex_name, io.StringIO())
+
+    def write_deduplicated():
+        written = {}
+        for chars, tex_name in zip(tables, names):
+            htf.write_htf(chars, tex_name, io.StringIO(), written)
+
+    def external():
+        for tex_name in names:
+            htf.external_alias('ec-' + tex_name + '-t1', io.StringIO())
+
+    def variants():
+        htf.variant_aliases(names, lambda tex_name: 'font-weight: bold;' if tex_name.endswith('1') else '', io.StringIO())
+
+    return {'write_htf': measure(write, repeat),
+            'write_htf_character_table': measure(write_compact, repeat),
+            'write_htf_deduplicated': measure(write_deduplicated, repeat),
+            # The peak memory of these two compares the sizes of the
+            # table types.
+            'build_dicts': measure(lambda: [{i: htf.character(*char) for i, char in chars.items()} for chars in tables], repeat),
+            'build_character_tables': measure(lambda: [htf.CharacterTable(chars) for chars in tables], repeat),
+            'htf_fingerprint': measure(lambda: [htf.htf_fingerprint(chars) for chars in tables], repeat),
+            'external_alias': measure(external, repeat),
+            'variant_aliases': measure(variants, repeat),
+            'plan_variants': measure(lambda: htf.plan_variants([name + suffix for name in names for suffix in ('', 'b', 'i', 'bi')],
+                                                               lambda tex_name: 'font-weight: bold;'), repeat)}
+
+
+def bench_type1(glyphs, repeat, directory):
+    """Times get_characters() with the type1 backend on a font with the given number of glyphs."""
+    pfb_file = os.path.join(directory, 'synthetic.pfb')
+    with open(pfb_file, 'wb') as pfb:
+        pfb.write(synthetic_pfb(glyphs))
+    return {'get_characters_type1': measure(lambda: htf.get_characters(pfb_file, backend = 'type1'), repeat)}
+
+
+def bench_fonts(count, repeat, directory):
+    """Times get_characters() and write_htfs() on count stub fonts."""
+    fonts_dir = os.path.join(directory, 'fonts')
+    output_dir = os.path.join(directory, 'htf')
+    os.makedirs(fonts_dir, exist_ok = True)
+    os.makedirs(output_dir, exist_ok = True)
+    fonts = []
+    for i in range(count):
+        name = 'stub%d' % i
+        open(os.path.join(fonts_dir, name + '.pfb'), 'w').close()
+        fonts.append(htf.map_entry(name, name, None, None, name + '.pfb'))
+
+    return {'get_characters_stub': measure(lambda: [htf.get_characters(font.type1_name, backend = 'stub') for font in fonts], repeat),
+            'write_htfs_stub': measure(lambda: htf.write_htfs(fonts, output_dir, [fonts_dir], workers = 1,
+                                                              force = True, backend = 'stub'), repeat)}
+
+
+def bench_validate(count, repeat, directory):
+    """Times validate_htfs() on count .htf files and two that miss its fast path."""
+    htf_dir = os.path.join(directory, 'validate')
+    os.makedirs(htf_dir, exist_ok = True)
+    for i in range(count):
+        with open(os.path.join(htf_dir, 'font%d.htf' % i), 'w') as f:
+            htf.write_htf(synthetic_characters(i), 'font%d' % i, f)
+    # Files that almost match the fast path used to make it backtrack
+    # for minutes.  A missing final newline is harmless, but junk
+    # after the footer isn't.
+    text = io.StringIO()
+    htf.write_htf(synthetic_characters(), 'junk', text)
+    with open(os.path.join(htf_dir, 'junk.htf'), 'w') as f:
+        f.write(text.getvalue() + 'junk\n')
+    text = io.StringIO()
+    htf.write_htf(synthetic_characters(), 'unterminated', text)
+    with open(os.path.join(htf_dir, 'unterminated.htf'), 'w') as f:
+        f.write(text.getvalue()[:-1])
+    results, checked = htf.validate_htfs([htf_dir])
+    if checked != count + 2 or [os.path.basename(name) for name in results] != ['junk.htf']:
+        raise AssertionError('validate_htfs() found the wrong problems: ' + repr(results))
+    return {'validate_htfs': measure(lambda: htf.validate_htfs([htf_dir]), repeat)}
+
+
+def bench_vf(packets, repeat, directory):
+    """Times read_vf(), VFResolver, and, if dvilike is installed, VFtoHTF."""
+    vf_file = os.path.join(directory, 'synthetic.vf')
+    with open(vf_file, 'wb') as f:
+        f.write(synthetic_vf(packets))
+    for font_num in range(4):
+        open(os.path.join(directory, 'real%d.pfb' % font_num), 'w').close()
+    fonts = [htf.map_entry('real%d' % i, 'real%d' % i, None, None, 'real%d.pfb' % i) for i in range(4)]
+
+    results = {'read_vf': measure(lambda: htf.read_vf(vf_file), repeat),
+               'VFResolver': measure(lambda: htf.VFResolver(fonts, [directory], 'stub').resolve(vf_file), repeat)}
+    if htf.VFProcessor is not None:
+        def reference():
+            machine = htf.VFtoHTF()
+            with open(vf_file, 'rb') as f:
+                for container in htf.VFProcessor(f):
+                    machine(container)
+            return machine
+        if dict(reference().chars) != dict(htf.read_vf(vf_file).chars):
+            raise AssertionError("read_vf() and VFtoHTF don't agree")
+        results['VFtoHTF'] = measure(reference, repeat)
+    return results
+
+
+def compare(results, baseline):
+    """Prints how the times in results compare to the times in baseline."""
+    old = {(stage['stage'], stage['size']): stage for stage in baseline['stages']}
+    for stage in results['stages']:
+        key = (stage['stage'], stage['size'])
+        if key in old:
+            print('{:<24} {:>8} {:>7.2f}x'.format(stage['stage'], stage['size'], old[key]['best'] / stage['best']))
+
+
+def main(argv = None):
+    """Handles the command line."""
+    parser = argparse.ArgumentParser(description = 'Benchmarks the functions in htf.py on synthetic input.')
+    parser.add_argument('-l', '--lines', type = int, nargs = '+', default = [10000, 100000], help = 'The numbers of lines in the synthetic map files.  The default is 10000 and 100000.')
+    parser.add_argument('-t', '--tables', type = int, nargs = '+', default = [10, 1000], help = 'The numbers of 256-position character tables to write.  The default is 10 and 1000.')
+    parser.add_argument('-g', '--glyphs', type = int, nargs = '+', default = [256, 2048], help = 'The numbers of glyphs in the synthetic Type 1 fonts.  The default is 256 and 2048.')
+    parser.add_argument('-v', '--packets', type = int, nargs = '+', default = [256, 4096], help = 'The numbers of packets in the synthetic VF files.  The default is 256 and 4096.')
+    parser.add_argument('-r', '--repeat', type = int, default = 5, help = 'How many times to run each function.  The default is 5.')
+    parser.add_argument('-o', '--output', help = 'Write the results to this file as JSON.')
+    parser.add_argument('-c', '--compare', help = 'Compare the results to an earlier JSON file.')
+    args = parser.parse_args(argv)
+
+    stages = []
+    def record(size, results):
+        for stage, result in results.items():
+            result = dict(result, stage = stage, size = size)
+            stages.append(result)
+            print('{:<24} {:>8} {:>10.4f} s {:>10.1f} KiB'.format(stage, size, result['best'], result['peak_memory'] / 1024))
+
+    for lines in args.lines:
+        record(lines, bench_map(lines, args.repeat))
+    for count in args.tables:
+        record(count, bench_tables(count, args.repeat))
+    with tempfile.TemporaryDirectory() as directory:
+        for glyphs in args.glyphs:
+            record(glyphs, bench_type1(glyphs, args.repeat, directory))
+        for count in args.tables:
+            record(count, bench_fonts(count, args.repeat, directory))
+            record(count, bench_validate(count, args.repeat, directory))
+        for packets in args.packets:
+            record(packets, bench_vf(packets, args.repeat, directory))
+
+    results = {'version': htf.__version__,
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+               'repeat': args.repeat,
+               'stages': stages}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,330 @@
 #!/usr/bin/python3
 
-import fontforge
-# import os.path
+import os
 import re
+import sys
+import array
 import collections
+import collections.abc
+import concurrent.futures
 import contextlib
+import functools
+import hashlib
+import io
+import json
 import logging
-from dvilike import OpcodeCommandsMachine, VFProcessor
+import mmap
+import struct
+import tempfile
+import threading
+import time
+try:
+    from dvilike import OpcodeCommandsMachine, VFProcessor
+except ImportError:
+    # Only VFtoHTF needs dvilike, and read_vf() reads VF files without
+    # it.
+    OpcodeCommandsMachine = object
+    VFProcessor = None
+
+
+__version__ = '1.1.1'
+
+# The named tuple get_characters() uses for glyphs.  It lives at the
+# module level so that the dictionaries get_characters() returns can
+# be pickled and sent between the processes write_htfs() starts.
+character = collections.namedtuple('character', 'code_point name')
+
+# The glyph names in all CharacterTables, each stored once, and the
+# indexes of the names in the list.
+_name_pool = ['']
+_name_ids = {'': 0}
+
+_new_tuple = tuple.__new__
+
+# What CharacterTable stores as the code point of an empty position
+# and of a character whose code point is in _extra.
+_empty = -2
+_extra_code_point = -3
+
+
+class CharacterTable(collections.abc.MutableMapping):
+    """A compact table of the characters at positions 0-255 in a font.
+
+    This works like the dictionaries of character named tuples
+    write_htf() accepts, but stores the code points in an array and
+    the glyph names as indexes into a pool of names shared by all the
+    tables in a process, so that keeping the tables for many fonts in
+    memory is cheap.  Code points that aren't ints of at least -1,
+    like the strings for characters that are sequences, are kept in a
+    separate dictionary.  Iterating over a table yields its positions
+    in order.
+
+    Tables can be hashed and compared quickly.  Like any dictionary
+    key, a table mustn't be changed while it's in a set or used as a
+    key.  Tables are pickled with their names as strings, so they can
+    be sent to processes with other name pools.
+    """
+
+    __slots__ = ('_code_points', '_names', '_extra', '_hash')
+
+    def __init__(self, chars = None):
+        """Makes a table, optionally with the characters in a mapping or an iterable of pairs."""
+        self._code_points = array.array('l', (_empty,)) * 256
+        self._names = array.array('i', (0,)) * 256
+        self._extra = {}
+        self._hash = None
+        if chars:
+            self.update(chars)
+
+    def __getitem__(self, position):
+        char = self.get(position)
+        if char is None:
+            raise KeyError(position)
+        return char
+
+    def get(self, position, default = None):
+        # This is what write_htf() calls for every position, so it
+        # avoids the exception handling in Mapping.get().
+        if type(position) != int or not 0 <= position < 256 or self._code_points[position] == _empty:
+            return default
+        code_point = self._code_points[position]
+        if code_point == _extra_code_point:
+            code_point = self._extra[position]
+        # This is faster than calling character().
+        return _new_tuple(character, (code_point, _name_pool[self._names[position]]))
+
+    def pairs(self, first = 0, last = 255):
+        """Returns a list of tuples of the code points and names at positions first to last.
+
+        Empty positions are None.  This is much faster than looking
+        each position up, since it doesn't make named tuples.
+        """
+        extra = self._extra
+        return [None if code_point == _empty else
+                (extra[position] if code_point == _extra_code_point else code_point, _name_pool[name])
+                for position, code_point, name in zip(range(first, last + 1), self._code_points[first:last + 1],
+                                                      self._names[first:last + 1])]
+
+    def __setitem__(self, position, char):
+        if type(position) != int or not 0 <= position < 256:
+            raise KeyError('CharacterTable positions are 0-255, not ' + repr(position))
+        code_point, name = char
+        self._extra.pop(position, None)
+        if type(code_point) == int and -1 <= code_point < 2**31:
+            self._code_points[position] = code_point
+        else:
+            self._code_points[position] = _extra_code_point
+            self._extra[position] = code_point
+        self._names[position] = _name_id(name or '')
+        self._hash = None
+
+    def __delitem__(self, position):
+        if type(position) != int or not 0 <= position < 256 or self._code_points[position] == _empty:
+            raise KeyError(position)
+        self._code_points[position] = _empty
+        self._names[position] = 0
+        self._extra.pop(position, None)
+        self._hash = None
+
+    def __contains__(self, position):
+        return type(position) == int and 0 <= position < 256 and self._code_points[position] != _empty
+
+    def __iter__(self):
+        return (position for position, code_point in enumerate(self._code_points) if code_point != _empty)
+
+    def __len__(self):
+        return 256 - self._code_points.count(_empty)
+
+    def __eq__(self, other):
+        if isinstance(other, CharacterTable):
+            # Since the name pool is shared, two tables have the same
+            # names exactly when they have the same indexes.
+            return (self._code_points == other._code_points and self._names == other._names
+                    and self._extra == other._extra)
+        return super().__eq__(other)
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash((self._code_points.tobytes(), self._names.tobytes(),
+                               tuple(sorted(self._extra.items()))))
+        return self._hash
+
+    def __reduce__(self):
+        return (_character_table, (self._code_points, [_name_pool[index] for index in self._names], self._extra))
+
+    def __repr__(self):
+        return 'CharacterTable(' + repr(dict(self.items())) + ')'
+
+
+def _character_table(code_points, names, extra):
+    """Rebuilds a pickled CharacterTable."""
+    chars = CharacterTable()
+    chars._code_points = code_points
+    chars._extra = extra
+    chars._names = array.array('i', map(_name_id, names))
+    return chars
+
+
+def _name_id(name):
+    """Returns the index of a glyph name in _name_pool, adding the name if it's new."""
+    index = _name_ids.get(name)
+    if index is None:
+        index = _name_ids[name] = len(_name_pool)
+        _name_pool.append(sys.intern(name))
+    return index
+
+
+class Profiler:
+    """Records how long each stage of generating .htf files takes.
+
+    enable_profiling() makes a Profiler the active one, in the
+    module-level variable profiler.  While it's active, every call to
+    a function marked as a stage is recorded as an event with its
+    start time and duration, and the functions add to counters like
+    the number of fonts opened or bytes written.  The events can be
+    summed up as JSON or written as a Chrome trace-event file that
+    chrome://tracing or https://ui.perfetto.dev can display.
+
+    Attributes:
+        events: A list of (stage, start, duration, process ID, thread
+            ID) tuples, with times in seconds from time.perf_counter().
+        counters: A Counter from counter names to totals.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        """Records the time the code in a with block takes as an event."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.events.append((stage, start, time.perf_counter() - start,
+                                os.getpid(), threading.get_ident()))
+
+    def count(self, counter, n = 1):
+        """Adds n to a counter."""
+        self.counters[counter] += n
+
+    def merge(self, events, counters):
+        """Adds the events and counters of another Profiler, e.g. from another process."""
+        self.events.extend(events)
+        self.counters.update(counters)
+
+    def summary(self):
+        """Returns the number of calls, total time, and longest time of each stage, and the counters."""
+        stages = {}
+        for stage, start, duration, pid, tid in self.events:
+            totals = stages.setdefault(stage, {'calls': 0, 'total': 0.0, 'max': 0.0})
+            totals['calls'] += 1
+            totals['total'] += duration
+            totals['max'] = max(totals['max'], duration)
+        return {'stages': stages, 'counters': dict(self.counters)}
+
+    def write_summary(self, file_name):
+        """Writes summary() to a file as JSON."""
+        with open(file_name, 'w') as f:
+            json.dump(self.summary(), f, indent = 1, sort_keys = True)
+
+    def write_trace(self, file_name):
+        """Writes the events to a file in the Chrome trace-event format.
+
+        The format description is here:
+        https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+        """
+        origin = min((event[1] for event in self.events), default = 0.0)
+        trace = [{'name': stage, 'cat': 'htf', 'ph': 'X', 'ts': (start - origin) * 1e6,
+                  'dur': duration * 1e6, 'pid': pid, 'tid': tid}
+                 for stage, start, duration, pid, tid in self.events]
+        end = max((event[1] + event[2] - origin for event in self.events), default = 0.0)
+        trace.append({'name': 'counters', 'ph': 'C', 'ts': end * 1e6, 'pid': os.getpid(),
+                      'args': dict(self.counters)})
+        with open(file_name, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+# The active Profiler, or None when profiling is off.
+profiler = None
+
+# The qualified names of the functions marked by _stage() and the
+# names of their stages.
+_stages = []
+
+
+def _stage(name):
+    """Marks a function or method as a stage for profiling.
+
+    The function itself is returned unchanged: enable_profiling()
+    replaces it with a timed version and disable_profiling() puts it
+    back, so stages cost nothing when profiling is off.
+    """
+    def mark(function):
+        _stages.append((function.__qualname__, name))
+        return function
+    return mark
+
+
+def _timed(function, stage):
+    """Returns a version of function that records its calls in the active Profiler."""
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        active = profiler
+        if active is None:
+            return function(*args, **kwargs)
+        with active.span(stage):
+            return function(*args, **kwargs)
+    return timed
+
+
+def _stage_owners():
+    """Yields the module or class each stage is an attribute of, its attribute name, and its stage name."""
+    module = sys.modules[__name__]
+    for qualname, stage in _stages:
+        owner = module
+        *path, attribute = qualname.split('.')
+        for part in path:
+            owner = getattr(owner, part)
+        yield owner, attribute, stage
+
+
+def enable_profiling():
+    """Starts recording stages and counters in a new Profiler.
+
+    Only functions looked up in this module after this call, and
+    VFtoHTF instances created after it, are timed.
+
+    Returns:
+        The new active Profiler.
+    """
+    global profiler
+    for owner, attribute, stage in _stage_owners():
+        function = owner.__dict__[attribute]
+        if not hasattr(function, '__wrapped__'):
+            setattr(owner, attribute, _timed(function, stage))
+    profiler = Profiler()
+    return profiler
+
+
+def disable_profiling():
+    """Stops profiling and puts the untimed functions back.
+
+    Returns:
+        The Profiler that was active, or None.
+    """
+    global profiler
+    for owner, attribute, stage in _stage_owners():
+        function = owner.__dict__[attribute]
+        if hasattr(function, '__wrapped__'):
+            setattr(owner, attribute, function.__wrapped__)
+    active = profiler
+    profiler = None
+    return active
 
 
+@_stage('parse_map')
 def parse_map(map_file):
     """Extracts font names, encodings, and Type1 glyph files from a map file.
 
@@ -72,9 +388,229 @@ def parse_map(map_file):
                 elif tex_name == ps_name:
                     ps_name = word
             fonts.append(font(tex_name, ps_name, ps_code, enc_name, type1_name))
+    if profiler is not None:
+        profiler.count('map_entries', len(fonts))
     return fonts
 
 
+# The named tuple iter_map() yields for each font in a map file.
+map_entry = collections.namedtuple('map_entry', 'tex_name ps_name ps_code enc_name type1_name')
+
+# Matches the words in a map file that name files, in one pattern:
+# encoding files (words starting with '<[' or starting with '<' and
+# ending with '.enc') in the first group, and Type 1 glyph files
+# (words starting with '<<' or starting with '<' and ending with
+# '.pf[ab]') in the second.
+_map_file_regex = re.compile(r'<(?:(\[\S+|\S+\.enc)|(<\S+|\S+\.pf[ab]))')
+
+
+def iter_map(map_file):
+    """Extracts font names, encodings, and Type1 glyph files from a map file lazily.
+
+    This is a faster version of parse_map() for large map files that
+    yields fonts one at a time instead of building a list.  It reads
+    each line in a single pass: Postscript code is split off at the
+    double quotes, and only the words starting with '<' are matched
+    against a regex, once.  Unlike parse_map(), it skips lines without
+    any words instead of returning empty entries for them.
+
+    Args:
+        map_file: A readable file object pointing to a map file, any
+            other iterable of lines, or the name of a map file.
+
+    Yields:
+        A map_entry named tuple for each font in the map file, with the
+        same fields parse_map() returns.
+    """
+    if isinstance(map_file, str):
+        with open(map_file) as lines:
+            yield from iter_map(lines)
+        return
+
+    comments = (' ', '%', '*', ';', '#')
+    match = _map_file_regex.match
+    new_entry = map_entry.__new__
+    for line in map_file:
+        if line.startswith(comments):
+            continue
+        ps_code = None
+        enc_name = None
+        type1_name = None
+        if '"' in line:
+            parts = line.split('"')
+            # Only the first Postscript code is kept, but all of them
+            # are removed from the line.  An unmatched double quote
+            # stays where it is.
+            if len(parts) > 2:
+                ps_code = parts[1]
+                words = parts[0::2]
+                if not len(parts) % 2:
+                    words.append('"' + parts[-1])
+                line = ''.join(words)
+        tex_name = None
+        ps_name = None
+        for word in line.split():
+            if word[0] == '<':
+                file_match = match(word)
+                if file_match:
+                    enc, type1 = file_match.groups()
+                    if enc:
+                        enc_name = enc.lstrip('[')
+                    else:
+                        type1_name = type1.lstrip('<')
+                    continue
+            # As in parse_map(), the first plain word is the TeX name
+            # and the second is the Postscript name.
+            if not tex_name:
+                tex_name = word
+                ps_name = word
+            elif tex_name == ps_name:
+                ps_name = word
+        if tex_name:
+            yield new_entry(map_entry, tex_name, ps_name, ps_code, enc_name, type1_name)
+
+
+class MapIndex:
+    """An index of the fonts in many map files, stored in SQLite.
+
+    Looking a TeX name up in every map file of a TeX distribution
+    means parsing all of them, so this parses each map file once and
+    keeps the entries in an SQLite database with indexes on the TeX
+    and Postscript names.  update() only parses the map files that
+    changed since the last update, according to their sizes and
+    modification times.
+
+    When a name appears more than once, the entry from the map file
+    earliest in the list passed to update() wins, and within a map
+    file, the entry on the earliest line wins, as with dvips's map
+    files and VFResolver.  lookup() returns all the entries in that
+    order.
+
+    A MapIndex has a get() method, so it can be passed to VFResolver
+    instead of a list of map entries.
+
+    Attributes:
+        index_file: The name of the SQLite database.
+    """
+
+    def __init__(self, index_file):
+        import sqlite3
+        self.index_file = index_file
+        self._connection = sqlite3.connect(index_file)
+        with self._connection:
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS maps (
+                    id INTEGER PRIMARY KEY,
+                    path TEXT UNIQUE NOT NULL,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    precedence INTEGER,
+                    version TEXT);
+                CREATE TABLE IF NOT EXISTS fonts (
+                    map_id INTEGER NOT NULL REFERENCES maps (id),
+                    line INTEGER NOT NULL,
+                    tex_name TEXT NOT NULL,
+                    ps_name TEXT,
+                    ps_code TEXT,
+                    enc_name TEXT,
+                    type1_name TEXT);
+                CREATE INDEX IF NOT EXISTS fonts_tex_name ON fonts (tex_name);
+                CREATE INDEX IF NOT EXISTS fonts_ps_name ON fonts (ps_name);
+                CREATE INDEX IF NOT EXISTS fonts_map_id ON fonts (map_id);''')
+
+    def update(self, map_files):
+        """Makes the index hold the fonts in exactly these map files.
+
+        Args:
+            map_files: Names of map files and of directories to index
+                all the .map files in, in order of precedence.  The map
+                files in a directory come in the order of their paths.
+
+        Returns:
+            The number of map files that were parsed.
+        """
+        paths = []
+        for name in map_files:
+            if os.path.isdir(name):
+                for root, dirs, names in os.walk(name):
+                    dirs.sort()
+                    paths.extend(os.path.join(root, file_name) for file_name in sorted(names)
+                                 if file_name.endswith('.map'))
+            else:
+                paths.append(name)
+        paths = list(dict.fromkeys(os.path.abspath(path) for path in paths))
+
+        parsed = 0
+        with self._connection as connection:
+            known = {path: (map_id, size, mtime_ns, version) for map_id, path, size, mtime_ns, version
+                     in connection.execute('SELECT id, path, size, mtime_ns, version FROM maps')}
+            for path in set(known) - set(paths):
+                connection.execute('DELETE FROM fonts WHERE map_id = ?', (known[path][0],))
+                connection.execute('DELETE FROM maps WHERE id = ?', (known[path][0],))
+            for precedence, path in enumerate(paths):
+                stat = os.stat(path)
+                old = known.get(path)
+                if old and old[1:] == (stat.st_size, stat.st_mtime_ns, __version__):
+                    connection.execute('UPDATE maps SET precedence = ? WHERE id = ?', (precedence, old[0]))
+                    continue
+                if old:
+                    connection.execute('DELETE FROM fonts WHERE map_id = ?', (old[0],))
+                    connection.execute('DELETE FROM maps WHERE id = ?', (old[0],))
+                map_id = connection.execute(
+                    'INSERT INTO maps (path, size, mtime_ns, precedence, version) VALUES (?, ?, ?, ?, ?)',
+                    (path, stat.st_size, stat.st_mtime_ns, precedence, __version__)).lastrowid
+                connection.executemany('INSERT INTO fonts VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                       ((map_id, line) + tuple(entry)
+                                        for line, entry in enumerate(iter_map(path))))
+                parsed += 1
+        return parsed
+
+    _select = ('SELECT fonts.tex_name, fonts.ps_name, fonts.ps_code, fonts.enc_name, fonts.type1_name '
+               'FROM fonts JOIN maps ON fonts.map_id = maps.id ')
+    _order = ' ORDER BY maps.precedence, fonts.line'
+
+    def get(self, tex_name, default = None):
+        """Returns the map entry that wins for a TeX name, or default."""
+        row = self._connection.execute(self._select + 'WHERE fonts.tex_name = ?' + self._order + ' LIMIT 1',
+                                       (tex_name,)).fetchone()
+        return map_entry(*row) if row else default
+
+    def get_ps_name(self, ps_name, default = None):
+        """Returns the map entry that wins for a Postscript name, or default."""
+        row = self._connection.execute(self._select + 'WHERE fonts.ps_name = ?' + self._order + ' LIMIT 1',
+                                       (ps_name,)).fetchone()
+        return map_entry(*row) if row else default
+
+    def lookup(self, tex_name = None, ps_name = None):
+        """Returns all the map entries with a TeX name or a Postscript name, in order of precedence.
+
+        Returns:
+            A list of tuples of the path of a map file and a map_entry.
+        """
+        if tex_name is not None:
+            where, name = 'WHERE fonts.tex_name = ?', tex_name
+        else:
+            where, name = 'WHERE fonts.ps_name = ?', ps_name
+        return [(row[0], map_entry(*row[1:])) for row in self._connection.execute(
+            self._select.replace('SELECT ', 'SELECT maps.path, ', 1) + where + self._order, (name,))]
+
+    def __contains__(self, tex_name):
+        return self.get(tex_name) is not None
+
+    def __len__(self):
+        """Returns the number of distinct TeX names."""
+        return self._connection.execute('SELECT COUNT(DISTINCT tex_name) FROM fonts').fetchone()[0]
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 def test_file(package, tex_names):
     """Generates a LaTeX file to test the .htfs for a font using fonttable.
 
@@ -93,7 +629,8 @@ def test_file(package, tex_names):
         test.write('\n\\end{document}\n')
 
 
-def write_htf(chars, tex_name, htf):
+@_stage('write_htf')
+def write_htf(chars, tex_name, htf, written = None):
     """ Writes a list of positions and characters to a file in .htf format.
 
     The format description for .htf files is here:
@@ -105,51 +642,145 @@ def write_htf(chars, tex_name, htf):
     or HTML entity to the output file, assigns characters to
     non-pictorial or pictorial classes based on whether they do or
     don't have a Unicode code point, and adds a comment including the
-    character's name (if any) and its position in the file.
+    character's name (if any) and its position in the file.  The whole
+    file is built in memory and written at once.
+
+    If written is given, this function first checks whether an .htf
+    file with the same characters, as htf_fingerprint() sees them, was
+    already written under another TeX name.  If so, it writes an alias
+    to that file with internal_alias() instead of the characters, so
+    tex4ht only has to load one of them.
     
     Args:
         chars: A dictionary with character positions as keys (255
            should be the highest position) and values as two-element
            named tuples, 'code_point' as an int and 'name' as a
-           string, of either one-element strings or a positive int
-           representing a Unicode code point (or -1 for characters
-           without code points) and an optional string representing a
-           character name.
+           string, of either strings (more than one character for
+           sequences) or a positive int representing a Unicode code
+           point (or -1 for characters without code points) and an
+           optional string representing a character name.  Missing
+           positions are written as blank lines.  A CharacterTable
+           works too.
         htf: A writeable file object for the output .htf file.    
-    """
+        written: A dictionary with the fingerprints of .htf files
+           already written as keys and their TeX names as values,
+           which this function adds to.
 
-    htf.write(tex_name + " " + str(min(chars)) + " " + str(max(chars)) + "\n")
-    for i in range(min(chars), max(chars)):
+    Returns:
+        The TeX name of the font the .htf file is an alias to, or None
+        if the characters were written out.
+    """
+    if written is not None:
+        fingerprint = htf_fingerprint(chars)
+        # An alias to the font's own name would be a cycle, which
+        # happens when the same font is written twice.
+        if fingerprint in written and written[fingerprint] != tex_name:
+            internal_alias(written[fingerprint], htf)
+            if profiler is not None:
+                profiler.count('aliases_written')
+            return written[fingerprint]
+        written[fingerprint] = tex_name
+
+    first = min(chars)
+    last = max(chars)
+    header = tex_name + " " + str(first) + " " + str(last) + "\n"
+    lines = [header]
+    append = lines.append
+    if isinstance(chars, CharacterTable):
+        entries = chars.pairs(first, last)
+    else:
+        entries = map(chars.get, range(first, last + 1))
+    for i, char in zip(range(first, last + 1), entries):
         # Read this as "if there is a glyph at this position"
-        if chars[i]:
-            if chars[i].str == -1:
+        if char:
+            code_point, name = char
+            if code_point == -1:
                 # I request a pictorial character for glyphs without
                 # Unicode code points by setting the class, the second
                 # field in the .htf file, to '1'.
-                htf.write("'' '1' " + str(i) + " " + chars[i].name + "\n")
-            elif type(chars[i].str) == string and len(chars[i].str) == 1:
-                htf.write(chars[i].str + " '' " + str(i) + " " + chars[i].name + "\n")
-            elif type(chars[i].str) == int and chars[i].str > 0:
-                htf.write("'&#" + hex(chars[i].str).lstrip("0") + ";' '' " + str(i) + " " + chars[i].name + "\n")
+                append(_pictorial_fragments[i] + name + "\n")
+            elif type(code_point) == int and code_point > 0:
+                append("'&#x%x;" % code_point + _character_fragments[i] + name + "\n")
+            elif type(code_point) == str and code_point:
+                append("'" + _htf_string(code_point) + _character_fragments[i] + name + "\n")
             else:
                 logging.error('The output routine write_htf encountered a bad character, probably because of malformed input.')
+                append(_blank_lines[i])
         else:
             # No character here, write a blank line.
-            htf.write("'' '' " + str(i) + "\n")
-    htf.write(tex_name + " " + str(min(chars)) + " " + str(max(chars)) + "\n")
+            append(_blank_lines[i])
+    append(header)
+    text = ''.join(lines)
+    htf.write(text)
+    if profiler is not None:
+        profiler.count('bytes_written', len(text))
+
+
+# The parts of the lines of .htf files that only depend on the
+# position, so that write_htf() doesn't have to build them for every
+# file.  Character lines are followed by the glyph's name.
+_blank_lines = tuple("'' '' " + str(i) + "\n" for i in range(256))
+_pictorial_fragments = tuple("'' '1' " + str(i) + " " for i in range(256))
+_character_fragments = tuple("' '' " + str(i) + " " for i in range(256))
+
+# Characters that have to be written as HTML entities: the reserved
+# characters in HTML and the delimiter write_htf() uses.
+_escapes = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;'}
 
 
-def get_characters(font_file, enc_file = None):
+def _htf_string(text):
+    """Returns a string for an .htf file, with entities for anything but printable ASCII."""
+    return ''.join(_escapes.get(c, c) if ' ' <= c <= '~' else '&#x%x;' % ord(c) for c in text)
+
+
+def htf_fingerprint(chars):
+    """Returns a hash of the characters in a table as tex4ht sees them.
+
+    Two tables with the same fingerprint produce the same output in
+    tex4ht: the glyph names, blank positions, and whether a character
+    is given as a string or a code point don't matter.
+
+    Args:
+        chars: A dictionary in the format write_htf() accepts.
+
+    Returns:
+        A hexadecimal SHA-1 hash.
+    """
+    digest = hashlib.sha1()
+    if isinstance(chars, CharacterTable):
+        entries = enumerate(chars.pairs())
+    else:
+        entries = ((i, chars[i]) for i in sorted(chars))
+    for i, char in entries:
+        if not char:
+            continue
+        code_point = char[0]
+        if code_point == -1:
+            entry = "%d '1'\n" % i
+        elif type(code_point) == int:
+            entry = "%d %x\n" % (i, code_point)
+        else:
+            entry = "%d %s\n" % (i, ' '.join('%x' % ord(c) for c in code_point))
+        digest.update(entry.encode())
+    return digest.hexdigest()
+
+
+@_stage('get_characters')
+def get_characters(font_file, enc_file = None, backend = 'fontforge'):
     """ Gets a list of characters from a font's glyph file in encoding order.
 
-    This function uses FontForge to get the Unicode code points for
-    each glyph from a font file.  Theoretically, it can handle any
-    font file that FontForge can read, but tex4ht can only handle
-    Type1 font files.
+    By default, this function uses FontForge to get the Unicode code
+    points for each glyph from a font file.  Theoretically, it can
+    handle any font file that FontForge can read, but tex4ht can only
+    handle Type1 font files.  The 'type1' backend reads Type 1 files
+    and encoding files directly, without FontForge, which is much
+    faster.
 
     Args:
         font_file: The name of a font file to open.
         enc_file: The name of an encoding file to open.
+        backend: The name of a function in character_backends to read
+            the font file with.
 
     Returns:
        chars: A dictionary with character positions as keys (255
@@ -158,28 +789,793 @@ def get_characters(font_file, enc_file = None):
            a string, of either one-element strings or a positive int
            representing a Unicode code point (or -1 for characters
            without code points) and an optional string representing a
-           character name.
+           character name.  This is a CharacterTable, which works like
+           a dictionary.
     """
+    read = character_backends[backend]
+    if profiler is None:
+        return read(font_file, enc_file)
+    # The backends are looked up in character_backends rather than
+    # in the module, so I time them here instead of marking them as
+    # stages.
+    with profiler.span(backend):
+        return read(font_file, enc_file)
 
-    chars = {}
-    character = collections.namedtuple('character', 'code_point name')
+
+def _fontforge_characters(font_file, enc_file = None):
+    """The FontForge backend for get_characters()."""
+    # Importing FontForge is slow, so I only do it when it's needed.
+    import fontforge
+
+    chars = CharacterTable()
 
     with contextlib.closing(fontforge.open(font_file)) as font:
-        # Change the encoding, if necessary.
         if enc_file:
-            font.encoding = fontforge.loadEncodingFile(enc_file)
-
-        for glyph in font.glyphs('encoding'):
-            # When operating on font files with glyphs at positions
-            # 256 or higher, the iterator will happily return them but
-            # they're outside the positions that TeX cares about, so I
-            # have to break.
-            if glyph.encoding > 255:
-                break
-            chars[glyph.encoding] = character(glyph.unicode, glyph.glyphname)
+            # Rather than having FontForge load the encoding file and
+            # reencode the font, I look the glyphs' names up in the
+            # encoding myself, which means the encoding file is only
+            # parsed once.
+            positions = encodings.get(enc_file).positions
+            for glyph in font.glyphs():
+                for position in positions.get(glyph.glyphname, ()):
+                    chars[position] = character(glyph.unicode, glyph.glyphname)
+        else:
+            glyphs = font.glyphs('encoding')
+            for glyph in glyphs:
+                # When operating on font files with glyphs at
+                # positions 256 or higher, the iterator will happily
+                # return them but they're outside the positions that
+                # TeX cares about, so I have to break.
+                if glyph.encoding > 255:
+                    if profiler is not None:
+                        profiler.count('glyphs_above_255_skipped', 1 + sum(1 for glyph in glyphs))
+                    break
+                chars[glyph.encoding] = character(glyph.unicode, glyph.glyphname)
+    # FontForge only knows the code points of some glyph names, so I
+    # look the rest up myself.
+    resolved = resolve_unicode(chars)
+    if profiler is not None:
+        profiler.count('fonts_opened')
+        profiler.count('glyphs_read', len(chars))
+        profiler.count('code_points_resolved', resolved)
     return chars
 
 
+def _type1_characters(font_file, enc_file = None):
+    """The pure Python backend for get_characters().
+
+    Positions whose glyph names don't appear in the font's CharStrings
+    are left out, as FontForge does.
+    """
+    font = read_type1(font_file)
+    chars = CharacterTable()
+    if profiler is not None:
+        profiler.count('fonts_opened')
+    if enc_file:
+        positions = encodings.get(enc_file).positions
+        for name in font.glyph_names:
+            for position in positions.get(name, ()):
+                chars[position] = character(glyph_unicode(name), name)
+    else:
+        for position, name in enumerate(font.encoding):
+            if name in font.glyph_names and name != '.notdef':
+                chars[position] = character(glyph_unicode(name), name)
+    if profiler is not None:
+        profiler.count('glyphs_read', len(chars))
+    return chars
+
+
+character_backends = {'fontforge': _fontforge_characters,
+                      'type1': _type1_characters}
+
+
+# Adobe's StandardEncoding, which Type 1 fonts can use instead of
+# defining their own /Encoding array, as a dictionary from positions to
+# glyph names.  It's from Appendix E of the PostScript Language
+# Reference Manual.
+standard_encoding = dict(enumerate(
+    'space exclam quotedbl numbersign dollar percent ampersand quoteright '
+    'parenleft parenright asterisk plus comma hyphen period slash zero one '
+    'two three four five six seven eight nine colon semicolon less equal '
+    'greater question at A B C D E F G H I J K L M N O P Q R S T U V W X Y '
+    'Z bracketleft backslash bracketright asciicircum underscore quoteleft '
+    'a b c d e f g h i j k l m n o p q r s t u v w x y z braceleft bar '
+    'braceright asciitilde'.split(), 32))
+standard_encoding.update(zip(
+    (161, 162, 163, 164, 165, 166, 167, 168, 169, 170, 171, 172, 173, 174,
+     175, 177, 178, 179, 180, 182, 183, 184, 185, 186, 187, 188, 189, 191,
+     193, 194, 195, 196, 197, 198, 199, 200, 202, 203, 205, 206, 207, 208,
+     225, 227, 232, 233, 234, 235, 241, 245, 248, 249, 250, 251),
+    'exclamdown cent sterling fraction yen florin section currency '
+    'quotesingle quotedblleft guillemotleft guilsinglleft guilsinglright fi '
+    'fl endash dagger daggerdbl periodcentered paragraph bullet '
+    'quotesinglbase quotedblbase quotedblright guillemotright ellipsis '
+    'perthousand questiondown grave acute circumflex tilde macron breve '
+    'dotaccent dieresis ring cedilla hungarumlaut ogonek caron emdash AE '
+    'ordfeminine Lslash Oslash OE ordmasculine ae dotlessi lslash oslash oe '
+    'germandbls'.split()))
+
+
+# Adobe's Glyph List and Glyph List For New Fonts, which live next to
+# this file.
+_glyph_list_files = [os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+                    for name in ('glyphlist.txt', 'aglfn.txt')]
+
+# The dictionary from glyph names to Unicode text _load_glyph_list()
+# builds the first time it's needed.
+_glyph_list = None
+
+
+def _load_glyph_list():
+    """Builds the dictionary of glyph names in the Adobe Glyph List files.
+
+    glyphlist.txt has lines of a name and the code points it stands
+    for, and aglfn.txt has lines of a code point, a name, and the
+    Unicode name.  The AGL has every name in the AGLFN, and the AGL
+    wins if they ever disagree, so aglfn.txt only adds the names the
+    AGL doesn't have.
+    """
+    global _glyph_list
+    names = {}
+    glyph_list_file, aglfn_file = _glyph_list_files
+    with open(glyph_list_file, encoding = 'ascii') as lines:
+        for line in lines:
+            if not line.startswith('#') and ';' in line:
+                name, code_points = line.split(';')
+                names[name] = ''.join(chr(int(code_point, 16)) for code_point in code_points.split())
+    with open(aglfn_file, encoding = 'ascii') as lines:
+        for line in lines:
+            if not line.startswith('#') and ';' in line:
+                code_point, name, _ = line.split(';', 2)
+                names.setdefault(name, chr(int(code_point, 16)))
+    _glyph_list = names
+    return names
+
+
+_uni_name_regex = re.compile('uni((?:[0-9A-F]{4})+)|u([0-9A-F]{4,6})')
+
+
+def glyph_unicode(name):
+    """Returns the Unicode text for a glyph name, following the Adobe Glyph List Specification.
+
+    Anything after the first period, like the '.sc' in 'a.sc', is
+    dropped.  Names joined by underscores, like 'f_f_i', stand for
+    sequences of characters.  Each component is looked up in the Adobe
+    Glyph List, or else read as 'uniXXXX' (with any number of groups
+    of four hexadecimal digits) or 'uXXXX' to 'uXXXXXX'.  The list is
+    loaded the first time it's needed.
+
+    Args:
+        name: A glyph name.
+
+    Returns:
+        An int for a single code point, a str for a sequence, or -1
+        if any component is unknown.
+    """
+    glyph_list = _glyph_list or _load_glyph_list()
+    text = []
+    for component in name.split('.', 1)[0].split('_'):
+        if component in glyph_list:
+            text.append(glyph_list[component])
+            continue
+        match = _uni_name_regex.fullmatch(component)
+        if not match:
+            return -1
+        if match.group(1):
+            digits = match.group(1)
+            code_points = [int(digits[i:i + 4], 16) for i in range(0, len(digits), 4)]
+        else:
+            code_points = [int(match.group(2), 16)]
+        for code_point in code_points:
+            # Surrogates aren't characters.
+            if code_point > 0x10FFFF or 0xD800 <= code_point <= 0xDFFF:
+                return -1
+            text.append(chr(code_point))
+    # AGL names can stand for several code points themselves.
+    text = ''.join(text)
+    if not text:
+        return -1
+    return ord(text) if len(text) == 1 else text
+
+
+def resolve_unicode(chars):
+    """Fills in the code points of the characters without them from their glyph names.
+
+    FontForge leaves many glyphs without code points, which write_htf()
+    then writes as pictures.  This looks each name up only once per
+    table.
+
+    Args:
+        chars: A CharacterTable or a dictionary in the format
+            write_htf() accepts.  It's changed in place.
+
+    Returns:
+        The number of characters that got code points.
+    """
+    resolved = {}
+    count = 0
+    for position, char in list(chars.items()):
+        if char.code_point == -1 and char.name:
+            if char.name not in resolved:
+                resolved[char.name] = glyph_unicode(char.name)
+            if resolved[char.name] != -1:
+                chars[position] = character(resolved[char.name], char.name)
+                count += 1
+    return count
+
+
+# The result of read_type1().  encoding is a list of 256 glyph names
+# (or None for empty positions) and glyph_names is a set of the names
+# of all the glyphs in the font.
+type1_font = collections.namedtuple('type1_font', 'encoding glyph_names')
+
+# A PostScript name following a slash, as it appears in /Encoding
+# arrays and encoding files.
+_ps_name = rb'/([^\s/\[\]{}()<>%]+)'
+_encoding_entry_regex = re.compile(rb'dup\s+(\d+)\s*' + _ps_name + rb'\s+put')
+# A CharStrings entry: the glyph name, the length of the charstring,
+# and the name of the procedure that reads it (usually RD or -|).
+_charstring_regex = re.compile(rb'\s*' + _ps_name + rb'\s+(\d+)\s+\S+ ')
+_ps_token_regex = re.compile(rb'\s*\S+')
+
+
+@_stage('read_type1')
+def read_type1(font_file):
+    """Reads the encoding and glyph names from a Type 1 font file without FontForge.
+
+    The format description for Type 1 fonts is here:
+    https://adobe-type-tools.github.io/font-tech-notes/pdfs/T1_SPEC.pdf
+
+    Both PFB files (binary segments with six-byte headers) and PFA
+    files (the encrypted part in hexadecimal) work.  The encoding is
+    in the cleartext part of the font and is read from it where it
+    lies, but the glyph names are in the eexec-encrypted part, which
+    has to be decrypted.  The file is memory mapped, so the only copy
+    made of a PFB file is the decrypted text.
+
+    Args:
+        font_file: The name of a PFB or PFA file.
+
+    Returns:
+        A type1_font named tuple with the font's encoding and the
+        names of its glyphs.
+    """
+    with open(font_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+        if data[:1] == b'\x80':
+            cleartext, encrypted = _pfb_segments(data)
+        else:
+            eexec = data.find(b'eexec')
+            if eexec == -1:
+                raise ValueError(font_file + " isn't a Type 1 font file")
+            cleartext = (0, eexec)
+            end = data.find(b'cleartomark', eexec)
+            hexadecimal = re.sub(rb'\s', b'', data[eexec + 5:end if end != -1 else len(data)])
+            encrypted = bytes.fromhex(hexadecimal[:len(hexadecimal) & ~1].decode('ascii'))
+
+        encoding = [None] * 256
+        start = data.find(b'/Encoding', *cleartext)
+        if start == -1:
+            raise ValueError(font_file + " doesn't have an encoding")
+        if data[start:start + 40].split()[1] == b'StandardEncoding':
+            for position, name in standard_encoding.items():
+                encoding[position] = name
+        else:
+            for match in _encoding_entry_regex.finditer(data, start, cleartext[1]):
+                position = int(match.group(1))
+                if position < 256:
+                    encoding[position] = match.group(2).decode('latin-1')
+
+        glyph_names = _charstring_names(_eexec_decrypt(encrypted))
+        if isinstance(encrypted, memoryview):
+            encrypted.release()
+    return type1_font(encoding, glyph_names)
+
+
+def _pfb_segments(data):
+    """Finds the cleartext and encrypted parts of a PFB file.
+
+    Returns:
+        A tuple of the start and end of the first ASCII segment and a
+        memoryview of the binary segment.  If there's more than one
+        binary segment, they're joined, which means copying them.
+    """
+    cleartext = None
+    binary = []
+    offset = 0
+    # The last segment header, type 3, is only two bytes long.
+    while offset + 6 <= len(data):
+        marker, segment_type, length = struct.unpack_from('<BBI', data, offset)
+        if marker != 0x80 or segment_type == 3:
+            break
+        offset += 6
+        if segment_type == 1 and cleartext is None:
+            cleartext = (offset, offset + length)
+        elif segment_type == 2:
+            binary.append((offset, offset + length))
+        offset += length
+    if cleartext is None or not binary:
+        raise ValueError("PFB file doesn't have cleartext and encrypted segments")
+    if len(binary) == 1:
+        return cleartext, memoryview(data)[binary[0][0]:binary[0][1]]
+    return cleartext, b''.join(data[start:end] for start, end in binary)
+
+
+def _eexec_decrypt(encrypted, key = 55665):
+    """Decrypts eexec-encrypted bytes, dropping the four random bytes at the start.
+
+    The key for each byte depends on all the bytes before it, so
+    there's no way to skip ahead to the CharStrings.
+    """
+    plain = bytearray(len(encrypted))
+    for i, byte in enumerate(encrypted):
+        plain[i] = byte ^ (key >> 8)
+        key = ((byte + key) * 52845 + 22719) & 0xFFFF
+    return bytes(plain[4:])
+
+
+def _charstring_names(private):
+    """Returns the set of glyph names in the decrypted private part of a Type 1 font."""
+    names = set()
+    start = private.find(b'/CharStrings')
+    if start == -1:
+        return names
+    # Skip '/CharStrings 123 dict dup begin'.
+    offset = private.find(b'begin', start) + 5
+    match = _charstring_regex.match(private, offset)
+    while match:
+        names.add(match.group(1).decode('latin-1'))
+        # The charstrings are binary, so they have to be skipped by
+        # their lengths rather than searched.  After each one is the
+        # procedure that defines it, usually ND or |-.
+        offset = match.end() + int(match.group(2))
+        offset = _ps_token_regex.match(private, offset).end()
+        match = _charstring_regex.match(private, offset)
+    return names
+
+
+@_stage('read_encoding')
+def read_encoding(enc_file):
+    """Reads the glyph names from a dvips encoding (.enc) file.
+
+    Encoding files are PostScript code defining an array of 256 glyph
+    names, like '/ECEncoding [ /grave /acute ... ] def'.  Comments
+    start with '%' and run to the end of the line.
+
+    Args:
+        enc_file: The name of an encoding file.
+
+    Returns:
+        A list of the glyph names in the encoding, in order.
+    """
+    with open(enc_file, 'rb') as f:
+        text = re.sub(rb'%[^\r\n]*', b'', f.read())
+    start = text.find(b'[')
+    end = text.find(b']', start)
+    if start == -1 or end == -1:
+        raise ValueError(enc_file + " doesn't contain an encoding array")
+    return [name.decode('latin-1') for name in re.findall(_ps_name, text[start + 1:end])]
+
+
+# The result of EncodingRegistry.get().  names is the list of glyph
+# names in the encoding and positions is a dictionary from each glyph
+# name to a tuple of the positions (below 256) it appears at.
+encoding = collections.namedtuple('encoding', 'names positions')
+
+
+class EncodingRegistry:
+    """Parses each encoding file only once.
+
+    The fonts in a family, and most of the fonts in a TeX distribution,
+    share a handful of encoding files, so there's no reason to parse
+    an encoding file again for every font that uses it.  The registry
+    keeps each encoding file it reads, keyed by its absolute path, and
+    only reads it again if its modification time changes.  Both
+    get_characters() backends use the module-level registry,
+    encodings, so the encodings stay loaded between calls, including
+    between the fonts handled by each of write_htfs()'s worker
+    processes.
+    """
+
+    def __init__(self):
+        self._encodings = {}
+
+    def get(self, enc_file):
+        """Returns an encoding named tuple for an encoding file."""
+        path = os.path.abspath(enc_file)
+        mtime = os.stat(path).st_mtime_ns
+        if path in self._encodings and self._encodings[path][0] == mtime:
+            return self._encodings[path][1]
+        names = read_encoding(path)
+        if profiler is not None:
+            profiler.count('encodings_loaded')
+        positions = {}
+        for position, name in enumerate(names[:256]):
+            if name != '.notdef':
+                positions.setdefault(name, []).append(position)
+        result = encoding(names, {name: tuple(value) for name, value in positions.items()})
+        self._encodings[path] = (mtime, result)
+        return result
+
+    def clear(self):
+        """Forgets all the encodings."""
+        self._encodings.clear()
+
+
+encodings = EncodingRegistry()
+
+
+class CharacterCache:
+    """A persistent cache of get_characters() results, keyed by file contents.
+
+    The characters in a font only change when the bytes of its glyph
+    file or encoding file do, so this cache stores get_characters()
+    results in a directory under a hash of the font file, the encoding
+    file, the backend, and the version of this library.  Each entry is
+    a small JSON file.  Entries are written to temporary files and
+    renamed into place, so several processes can share a cache
+    directory without ever seeing half-written entries.  When the
+    entries take up more than max_size bytes, the least recently used
+    ones, according to their modification times, are deleted until
+    they take up nine tenths of it.  To keep misses cheap, each
+    process adds the sizes of the entries it writes to the total it
+    found the last time it looked at the whole directory, and only
+    looks again when that goes over max_size, so with several
+    processes the cache can briefly grow past max_size.
+
+    Attributes:
+        directory: The name of the cache directory.
+        max_size: The most bytes the entries should take up.
+        hits: The number of lookups that were answered by the cache.
+        misses: The number of lookups that had to read a font.
+    """
+
+    def __init__(self, directory, max_size = 64 * 2**20):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # The size of the entries as of the last scan of the directory
+        # plus the entries written since, or None before the first.
+        self._size = None
+        os.makedirs(directory, exist_ok = True)
+
+    def key(self, font_file, enc_file = None, backend = 'fontforge'):
+        """Returns the hash identifying the characters in a font."""
+        key = hashlib.sha256((__version__ + ' ' + backend).encode())
+        for name in (font_file, enc_file):
+            key.update(_file_digest(name) if name else bytes(32))
+        return key.hexdigest()
+
+    def get_characters(self, font_file, enc_file = None, backend = 'fontforge'):
+        """Works like get_characters(), but uses the cache."""
+        chars, hit = self.lookup(font_file, enc_file, backend)
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return chars
+
+    def lookup(self, font_file, enc_file = None, backend = 'fontforge'):
+        """Gets the characters in a font from the cache or else from the font.
+
+        This doesn't touch hits and misses, so that write_htfs() can
+        count the lookups its worker processes make.
+
+        Returns:
+            A tuple of the characters and whether they came from the
+            cache.
+        """
+        path = os.path.join(self.directory, self.key(font_file, enc_file, backend) + '.json')
+        try:
+            with open(path) as entry:
+                chars = CharacterTable((int(position), character(*value))
+                                       for position, value in json.load(entry).items())
+        except (OSError, ValueError):
+            # Missing entries, and any entry that got corrupted somehow,
+            # count as misses.
+            pass
+        else:
+            # Mark the entry as recently used.  Another process may
+            # have evicted it in the meantime, which doesn't matter.
+            with contextlib.suppress(OSError):
+                os.utime(path)
+            if profiler is not None:
+                profiler.count('cache_hits')
+            return chars, True
+
+        if profiler is not None:
+            profiler.count('cache_misses')
+        chars = get_characters(font_file, enc_file, backend)
+        with tempfile.NamedTemporaryFile('w', dir = self.directory, suffix = '.tmp', delete = False) as entry:
+            json.dump({position: list(value) for position, value in chars.items()}, entry)
+            written = entry.tell()
+        os.replace(entry.name, path)
+        if self._size is None:
+            self.evict()
+        else:
+            self._size += written
+            if self._size > self.max_size:
+                self.evict()
+        return chars, False
+
+    def evict(self):
+        """Deletes the least recently used entries if the cache doesn't fit in max_size.
+
+        Enough entries are deleted to bring the cache down to nine
+        tenths of max_size, so that the next ones can be added without
+        scanning the directory again right away.
+        """
+        entries = []
+        size = 0
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith('.json'):
+                    with contextlib.suppress(OSError):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                        size += stat.st_size
+        if size > self.max_size:
+            entries.sort()
+            for mtime, entry_size, path in entries:
+                # Another process may be evicting the same entries.
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                size -= entry_size
+                if size <= self.max_size * 0.9:
+                    break
+        self._size = size
+
+
+def _file_digest(name):
+    """Returns the SHA-256 hash of a file's contents as bytes."""
+    digest = hashlib.sha256()
+    with open(name, 'rb') as f:
+        for block in iter(lambda: f.read(2**16), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+def locate_files(search_path):
+    """Maps file names to paths for every file under a list of directories.
+
+    Map files only give the bare names of glyph and encoding files, so
+    they have to be found somewhere in the TeX tree.  Walking the
+    tree once and looking names up in a dictionary afterwards is much
+    faster than searching it again for each font.  Directories earlier
+    in search_path take precedence over later ones.
+
+    Args:
+        search_path: A list of directory names.
+
+    Returns:
+        A dictionary with file names as keys and paths as values.
+    """
+    files = {}
+    for directory in search_path:
+        for root, dirs, names in os.walk(directory):
+            # Walking in sorted order makes the result reproducible
+            # when a name appears more than once in the tree.
+            dirs.sort()
+            for name in sorted(names):
+                files.setdefault(name, os.path.join(root, name))
+    return files
+
+
+# The result of processing one font in write_htfs().  error is None
+# if the .htf file was written and a message otherwise, and alias is
+# the TeX name of the font the .htf file is an alias to, if it is one.
+batch_result = collections.namedtuple('batch_result', 'tex_name htf_file error alias')
+
+
+def _read_characters(job):
+    """Runs get_characters() for write_htfs(), catching any errors.
+
+    This has to be a module-level function so that the process pool
+    can pickle it.
+
+    Args:
+        job: A tuple of a font file name, an encoding file name (or
+            None), the name of a backend, a CharacterCache (or None),
+            and whether to profile the job.  Profiling is only needed
+            in worker processes, which don't share the calling
+            process's Profiler.
+
+    Returns:
+        A tuple of the characters and None, or of None and an error
+        message, followed by whether the characters came from the
+        cache and, when profiling, the events and counters the job
+        recorded (or None).
+    """
+    font_file, enc_file, backend, cache, profile = job
+    if profile:
+        enable_profiling()
+    try:
+        if cache:
+            chars, hit = cache.lookup(font_file, enc_file, backend)
+            result = chars, None, hit
+        else:
+            result = get_characters(font_file, enc_file, backend), None, False
+    except Exception as error:
+        result = None, type(error).__name__ + ': ' + str(error), False
+    if profile:
+        active = disable_profiling()
+        return result + ((active.events, active.counters),)
+    return result + (None,)
+
+
+def _pool_characters(jobs, workers):
+    """Yields the results of _read_characters() for jobs in a process pool, in order.
+
+    Each job is submitted separately, so a worker process that dies,
+    as FontForge can on a broken font, only costs the job that killed
+    it.  When the pool breaks, the first unfinished job is run again
+    alone in a new process: if that process dies too, the job gets an
+    error, and either way the jobs after it are resubmitted to a new
+    pool, keeping the results that had already come back.
+
+    Args:
+        jobs: A list of jobs for _read_characters().
+        workers: The number of processes, by default the number of
+            CPUs.
+    """
+    finished = {}
+    start = 0
+    while start < len(jobs):
+        broken = False
+        executor = concurrent.futures.ProcessPoolExecutor(workers)
+        try:
+            futures = {index: executor.submit(_read_characters, jobs[index])
+                       for index in range(start, len(jobs)) if index not in finished}
+            while start < len(jobs):
+                if start in finished:
+                    result = finished.pop(start)
+                else:
+                    try:
+                        result = futures[start].result()
+                    except concurrent.futures.process.BrokenProcessPool:
+                        broken = True
+                        # Some of the later jobs may have finished
+                        # before the pool broke.
+                        for index, future in futures.items():
+                            if (index > start and future.done() and not future.cancelled()
+                                    and not future.exception()):
+                                finished[index] = future.result()
+                        break
+                yield result
+                start += 1
+        finally:
+            executor.shutdown(cancel_futures = True)
+        if broken:
+            with concurrent.futures.ProcessPoolExecutor(1) as alone:
+                try:
+                    result = alone.submit(_read_characters, jobs[start]).result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    result = None, 'the worker process reading the font died', False, None
+            yield result
+            start += 1
+
+
+def write_htfs(fonts, output_dir = '.', search_path = ('.',), workers = None, force = False,
+               backend = 'fontforge', cache = None, deduplicate = False, font_css = None,
+               htf_index = None, files = None):
+    """Writes an .htf file for each font in a map file using a process pool.
+
+    Opening fonts with FontForge dominates the time it takes to
+    generate .htf files, so this function reads the characters for
+    different fonts in parallel processes.  The results come back in
+    the same order as the fonts, and the .htf files are written in
+    that order by the calling process, so the output doesn't depend on
+    how the work was scheduled.  An error in one font, even one that
+    kills its worker process, is recorded and logged but doesn't stop
+    the others.
+
+    Args:
+        fonts: Either the name of a map file or a list of the named
+            tuples parse_map() or iter_map() return.
+        output_dir: The directory to write the .htf files to.
+        search_path: A list of directories to search for the glyph
+            and encoding files named in the map file.
+        workers: The number of processes to use, by default the number
+            of CPUs.  With 1, everything runs in the calling process.
+        force: Whether to overwrite existing .htf files.
+        backend: The get_characters() backend to read fonts with.
+        cache: A CharacterCache to look fonts up in first.  Its hits
+            and misses include the lookups made by the workers.
+        deduplicate: Whether to write aliases to .htf files written
+            earlier in the batch for fonts with the same characters,
+            as write_htf() does with its written argument.
+        font_css: A function that takes a TeX name and returns CSS font
+            properties for the font, as for variant_aliases().  If
+            given, an htfcss line for the font is added to its .htf
+            file.
+        htf_index: An HTFIndex of installed .htf files.  Fonts with the
+            same characters as one of them become aliases to it.
+        files: A dictionary from file names to paths, as
+            locate_files() returns, to use instead of walking
+            search_path.
+
+    Returns:
+        A list of batch_result named tuples, one for each TeX name, in
+        the same order as fonts.  Fonts whose TeX names appeared
+        earlier in fonts are skipped.
+    """
+    if isinstance(fonts, str):
+        fonts = list(iter_map(fonts))
+    # parse_map() returns empty entries for blank lines.  As in
+    # VFResolver and MapIndex, the first entry for a TeX name wins.
+    first = {}
+    for font in fonts:
+        if font.tex_name:
+            first.setdefault(font.tex_name, font)
+    fonts = list(first.values())
+
+    if files is None:
+        files = locate_files(search_path)
+    # If the directory can't be created, every font gets the error
+    # from opening its .htf file below.
+    with contextlib.suppress(OSError):
+        os.makedirs(output_dir, exist_ok = True)
+    results = [None] * len(fonts)
+    jobs = []
+    # The indexes of the fonts that have jobs, in the same order as jobs.
+    indexes = []
+    for index, font in enumerate(fonts):
+        htf_file = os.path.join(output_dir, font.tex_name + '.htf')
+        if not font.type1_name:
+            error = 'no Type 1 glyph file in the map entry'
+        elif font.type1_name not in files:
+            error = "couldn't find " + font.type1_name
+        elif font.enc_name and font.enc_name not in files:
+            error = "couldn't find " + font.enc_name
+        elif not force and os.path.exists(htf_file):
+            error = "didn't overwrite " + htf_file
+        else:
+            jobs.append((files[font.type1_name], files.get(font.enc_name), backend, cache,
+                         profiler is not None and workers != 1))
+            indexes.append(index)
+            continue
+        results[index] = batch_result(font.tex_name, htf_file, error, None)
+
+    written = (htf_index.written() if htf_index else {}) if deduplicate else None
+    with contextlib.ExitStack() as stack:
+        if workers == 1:
+            characters = map(_read_characters, jobs)
+        else:
+            characters = stack.enter_context(contextlib.closing(_pool_characters(jobs, workers)))
+        for index, (chars, error, hit, profile) in zip(indexes, characters):
+            if profile:
+                profiler.merge(*profile)
+            if cache and not error:
+                if hit:
+                    cache.hits += 1
+                else:
+                    cache.misses += 1
+            tex_name = fonts[index].tex_name
+            htf_file = os.path.join(output_dir, tex_name + '.htf')
+            alias = None
+            if chars:
+                try:
+                    with open(htf_file, 'w') as htf:
+                        # Without deduplicate, each font gets its own
+                        # written dictionary, so it's only compared to
+                        # the installed files.
+                        alias = write_htf(chars, tex_name, htf,
+                                          htf_index.written() if htf_index and not deduplicate else written)
+                        if font_css:
+                            variant_aliases([tex_name], font_css, htf)
+                except OSError as exception:
+                    error = str(exception)
+                    alias = None
+            elif not error:
+                error = 'no glyphs at positions 0-255'
+            results[index] = batch_result(tex_name, htf_file, error, alias)
+
+    for result in results:
+        if result.error:
+            logging.error(result.tex_name + ': ' + result.error)
+    return results
+
+
 # T1 /usr/share/texmf/tex4ht/ht-fonts/unicode/lm/lm-ec.htf
 # TS1 /usr/share/texmf/tex4ht/ht-fonts/unicode/jknappen/tc/tcrm.htf
 # OMS /usr/share/texmf/tex4ht/ht-fonts/unicode/cm/cmsy.htf
@@ -208,27 +1604,63 @@ known_encodings = {'t1': 'lm-ec',
                    'x2' : 'ldrm',
                    'lgr' : 'grmn'}
 
+# Matches the encoding tags that stand alone in a TeX name, between
+# hyphens or other punctuation or at either end, so that the 'tt1' in
+# 'lmtt10-ot1' isn't taken for 't1'.
+_encoding_tag_regex = re.compile('(?<![a-z0-9])(?:' + '|'.join(re.escape(tag) for tag in sorted(known_encodings, key = len, reverse = True)) + ')(?![a-z0-9])')
+
+
+def _encoding_tag(tex_name):
+    """Returns the last encoding tag that stands alone in a TeX name, or None."""
+    tag = None
+    for match in _encoding_tag_regex.finditer(tex_name.lower()):
+        tag = match.group()
+    return tag
+
+
+@_stage('external_alias')
 def external_alias(tex_name, htf):
     """Writes an alias to an .htf file included with tex4ht.
 
     tex4ht accepts the name of an existing .htf file in lieu of a list
     of characters.  This function uses a font's TeX name to select one
     of the .htf files packaged with tex4ht corresponding to one of the
-    standard TeX encodings.
+    standard TeX encodings.  Only tags that are whole components of
+    the name count, like the 'ot1' in 'lmtt10-ot1', and if there are
+    several, the last one is used.
 
     Args:
         tex_name: The TeX name of a font.
         htf: A writeable file object for the output .htf file.
+
+    Returns:
+        The name of the .htf file the alias is to, or None if the TeX
+        name doesn't contain an encoding tag.
     """
-    for encoding in known_encodings:
-        if encoding in tex_name.lower():
-            htf.write("." + known_encodings[encoding] + "\n")
+    tag = _encoding_tag(tex_name)
+    if not tag:
+        return None
+    alias = known_encodings[tag]
+    htf.write("." + alias + "\n")
+    if profiler is not None:
+        profiler.count('bytes_written', len(alias) + 2)
+    return alias
 
 
-# def internal_alias(tex_name, htf):
-#     htf.write("." + tex_name + "\n")
+@_stage('internal_alias')
+def internal_alias(tex_name, htf):
+    """Writes an alias to another .htf file generated from the same font files.
+
+    Args:
+        tex_name: The TeX name of the font whose .htf file to alias.
+        htf: A writeable file object for the output .htf file.
+    """
+    htf.write("." + tex_name + "\n")
+    if profiler is not None:
+        profiler.count('bytes_written', len(tex_name) + 2)
 
 
+@_stage('variant_aliases')
 def variant_aliases(tex_names, font_css, htf):
     """Adds aliases and appropriate CSS code to an .htf file.
 
@@ -250,10 +1682,859 @@ def variant_aliases(tex_names, font_css, htf):
             assign it appropripate CSS font properties.
         htf: A writeable file object for the output .htf file.
     """
+    block = _htfcss_block((tex_name, font_css(tex_name)) for tex_name in tex_names)
+    # Writing the whole block at once is much faster than a write()
+    # for each line when there are many variants.
+    htf.write(block)
+    if profiler is not None:
+        profiler.count('bytes_written', len(block))
+
+
+def _htfcss_block(variants):
+    """Returns the htfcss lines for pairs of TeX names and CSS, skipping the ones without CSS."""
+    return ''.join('htfcss: ' + tex_name + ' ' + css + '\n' for tex_name, css in variants if css)
+
+
+# A group of fonts that share an .htf file: the TeX name of the font
+# the file is named after, and a list of pairs of the TeX names of it
+# and its variants and their CSS font properties, with the base font
+# first.
+variant_group = collections.namedtuple('variant_group', 'base variants')
+
+
+@_stage('plan_variants')
+def plan_variants(tex_names, font_css, group = None, css = None):
+    """Sorts fonts into the fewest .htf files that tex4ht can find them all in.
+
+    tex4ht only applies the htfcss lines in an .htf file to fonts whose
+    TeX names can be truncated to the name of the file, so each font
+    goes in the file of the shortest of the other names that's a prefix
+    of its name, and fonts without such a prefix get their own files.
+    The names are put in a trie, so this takes time proportional to
+    their total length rather than comparing every pair of names.
+
+    Args:
+        tex_names: The TeX names of the fonts, in any order.
+            Duplicates are ignored.
+        font_css: A function that uses the TeX name of a font to
+            assign it CSS font properties, as for variant_aliases().
+        group: An optional function that takes a TeX name and returns
+            a key, like an encoding or a family, so that only fonts
+            with the same key share a file.  Fonts with different
+            characters shouldn't.
+        css: An optional dictionary from TeX names to the CSS font_css
+            returned for them.  font_css is only called for names
+            missing from it, and they're added, so passing the same
+            dictionary to several calls calls font_css only once for
+            each font.
+
+    Returns:
+        A list of variant_groups, in the order of the first of their
+        fonts in tex_names.
+    """
+    if css is None:
+        css = {}
+    # Each node of a trie is a dictionary from letters to nodes, and
+    # the node a name ends at has the name under the key ''.
+    tries = {}
+    names = []
     for tex_name in tex_names:
-        css = font_css(tex_name)
-        if css:
-            htf.write("htfcss: " + tex_name + " " + css + "\n")
+        key = group(tex_name) if group else None
+        node = tries.setdefault(key, {})
+        for letter in tex_name:
+            node = node.setdefault(letter, {})
+        if '' not in node:
+            node[''] = tex_name
+            names.append((tex_name, key))
+
+    groups = {}
+    for tex_name, key in names:
+        node = tries[key]
+        for letter in tex_name:
+            node = node[letter]
+            if '' in node:
+                break
+        base = node['']
+        if tex_name not in css:
+            css[tex_name] = font_css(tex_name)
+        groups.setdefault(base, []).append((tex_name, css[tex_name]))
+    if profiler is not None:
+        profiler.count('fonts_planned', len(names))
+        profiler.count('htf_files_planned', len(groups))
+
+    plan = []
+    for base, variants in groups.items():
+        # The base font can come after its variants in tex_names.
+        variants.sort(key = lambda variant: variant[0] != base)
+        plan.append(variant_group(base, variants))
+    return plan
+
+
+@_stage('write_variants')
+def write_variants(plan, output_dir = '.'):
+    """Adds the htfcss lines of the groups plan_variants() returns to their .htf files.
+
+    As with variant_aliases(), the .htf files must already exist,
+    written with write_htf() or external_alias().  Each file gets its
+    lines in a single write.
+
+    Args:
+        plan: A list of variant_groups.
+        output_dir: The directory the .htf files are in.
+
+    Returns:
+        A list of the names of the .htf files that were changed.  Groups
+        whose .htf file doesn't exist are logged and skipped.
+    """
+    changed = []
+    for base, variants in plan:
+        block = _htfcss_block(variants)
+        if not block:
+            continue
+        htf_file = os.path.join(output_dir, base + '.htf')
+        if not os.path.exists(htf_file):
+            logging.error(base + ': ' + htf_file + " doesn't exist")
+            continue
+        with open(htf_file, 'a') as htf:
+            htf.write(block)
+        if profiler is not None:
+            profiler.count('bytes_written', len(block))
+        changed.append(htf_file)
+    return changed
+
+
+# The contents of an .htf file: the TeX name in its header, the name
+# of the file it's an alias to (or None), and its characters in the
+# format write_htf() accepts.
+htf_table = collections.namedtuple('htf_table', 'tex_name alias chars')
+
+# The records iter_htf() yields for headers and footers, character
+# lines, and htfcss lines.  text is the string as it is in the file,
+# with any entities, and rest is what follows the class, usually the
+# position and the glyph name.
+htf_range = collections.namedtuple('htf_range', 'tex_name low high')
+htf_entry = collections.namedtuple('htf_entry', 'position text css_class rest')
+htf_css = collections.namedtuple('htf_css', 'tex_name css')
+
+_entity_regex = re.compile(r'&(?:#[xX]([0-9a-fA-F]+)|#([0-9]+)|(amp|lt|gt|quot|apos));')
+_named_entities = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+
+# Matches an ampersand that doesn't start an entity.
+_bad_entity_regex = re.compile(r'&(?!#[xX][0-9a-fA-F]+;|#[0-9]+;|[A-Za-z][A-Za-z0-9]*;)')
+
+# Matches hexadecimal entities that aren't Unicode characters: zero,
+# surrogates, and anything above 10FFFF.  Decimal entities are rare,
+# so I check those with int().
+_invalid_entity_regex = re.compile(r'&#[xX](?:0+|0*(?:[dD][89a-fA-F][0-9a-fA-F]{2}|(?:1[1-9a-fA-F]|[2-9a-fA-F][0-9a-fA-F])[0-9a-fA-F]{4}|[1-9a-fA-F][0-9a-fA-F]{6,}));')
+_decimal_entity_regex = re.compile(r'&#([0-9]+);')
+
+# Matches an .htf file as write_htf() and variant_aliases() write it:
+# the header, the character lines, the footer, and htfcss lines.  Each
+# character line can only match one way, so files that almost match
+# fail in linear time instead of backtracking exponentially.
+_written_htf_regex = re.compile(r"([^\s.]\S*) (\d+) (\d+)\n((?:'[^'\n]*' '[^'\n]*' \d+(?: [^\n]*)?\n)*)\1 \2 \3\n((?:htfcss: [^\n]*\n)*)\Z")
+_stated_position_regex = re.compile(r"^'[^'\n]*' '[^'\n]*' (\d+)", re.MULTILINE)
+
+
+def _entity(match):
+    hexadecimal, decimal, name = match.groups()
+    if name:
+        return _named_entities[name]
+    return chr(int(hexadecimal, 16) if hexadecimal else int(decimal))
+
+
+def iter_htf(htf):
+    """Parses an .htf file one line at a time.
+
+    This reads the files write_htf(), external_alias(),
+    internal_alias(), and variant_aliases() write and the ones
+    packaged with tex4ht.  An .htf file is either an alias line or a
+    header, a line for each position in the header's range, and the
+    header again as a footer, and either can be followed by htfcss
+    lines.  As in tex4ht, the first character of each character line
+    is the delimiter for its string, and the first character after the
+    string is the delimiter for its class.  Blank lines are skipped.
+
+    Args:
+        htf: The name of an .htf file, a file object, or any other
+            iterable of lines.
+
+    Yields:
+        Tuples of a line number, a kind, and a value: 'alias' and the
+        name of the aliased file, 'header' or 'footer' and an htf_range,
+        'character' and an htf_entry, 'css' and an htf_css, or 'error'
+        and a message for a line that doesn't fit the format.  After an
+        error in the header, nothing else is yielded.
+    """
+    with contextlib.ExitStack() as stack:
+        if isinstance(htf, str):
+            htf = stack.enter_context(open(htf, encoding = 'latin-1'))
+        header = None
+        position = high = None
+        # The number of the last line that wasn't blank.
+        last = 0
+        for number, line in enumerate(htf, 1):
+            line = line.rstrip('\r\n')
+            if not line or line.isspace():
+                continue
+            last = number
+            if position is not None:
+                if position <= high:
+                    end = line.find(line[0], 1)
+                    rest = line[end + 1:].lstrip()
+                    class_end = rest.find(rest[:1], 1)
+                    if end < 0 or class_end < 0:
+                        yield number, 'error', 'malformed line for position ' + str(position)
+                    else:
+                        yield number, 'character', htf_entry(position, line[1:end], rest[1:class_end],
+                                                              rest[class_end + 1:].strip())
+                    position += 1
+                    continue
+                fields = line.split()
+                footer = htf_range(fields[0], *map(int, fields[1:3])) if len(fields) >= 3 and fields[1].isdigit() and fields[2].isdigit() else None
+                if footer == header:
+                    yield number, 'footer', footer
+                else:
+                    yield number, 'error', 'footer ' + repr(line) + " doesn't match the header"
+                position = None
+                continue
+            if line.startswith('htfcss:'):
+                fields = line[7:].split(None, 1)
+                if fields:
+                    yield number, 'css', htf_css(fields[0], fields[1].strip() if len(fields) > 1 else '')
+                else:
+                    yield number, 'error', 'htfcss line without a font name'
+            elif header is not None:
+                yield number, 'error', 'unexpected line ' + repr(line)
+            elif line.startswith('.'):
+                yield number, 'alias', line[1:].split()[0] if line[1:].split() else ''
+                header = False
+            else:
+                fields = line.split()
+                if len(fields) < 3 or not fields[1].isdigit() or not fields[2].isdigit():
+                    yield number, 'error', "doesn't start with a header or an alias"
+                    return
+                header = htf_range(fields[0], int(fields[1]), int(fields[2]))
+                if header.low > header.high:
+                    yield number, 'error', 'the header range ' + str(header.low) + '-' + str(header.high) + ' is empty'
+                    return
+                yield number, 'header', header
+                position, high = header.low, header.high
+        if position is not None:
+            if position <= high:
+                yield last, 'error', 'ends at position ' + str(position) + ' of ' + str(high)
+            else:
+                yield last, 'error', 'ends without a footer'
+        elif header is None:
+            yield last, 'error', 'is empty'
+
+
+@_stage('read_htf')
+def read_htf(htf_file):
+    """Reads the characters in an .htf file.
+
+    Entities in the strings are decoded, so a character comes back the
+    same whether it was written as an entity or not.
+
+    Args:
+        htf_file: The name of an .htf file.
+
+    Returns:
+        An htf_table named tuple.  Characters with a class but no
+        string have the code point -1, as for write_htf(), and ones
+        whose strings are more than one character have them as str.
+
+    Raises:
+        ValueError: If the file doesn't start with an alias or a
+            header, or has a malformed character line or doesn't reach
+            the end of the range in its header.  Problems after that
+            are ignored; validate_htf() reports them.
+    """
+    tex_name = os.path.splitext(os.path.basename(htf_file))[0]
+    chars = {}
+    for number, kind, value in iter_htf(htf_file):
+        if kind == 'character':
+            text = _entity_regex.sub(_entity, value.text) if '&' in value.text else value.text
+            fields = value.rest.split()
+            name = fields[1] if len(fields) > 1 else ''
+            if len(text) == 1:
+                chars[value.position] = character(ord(text), name)
+            elif text:
+                chars[value.position] = character(text, name)
+            elif value.css_class:
+                chars[value.position] = character(-1, name)
+        elif kind == 'header':
+            tex_name = value.tex_name
+        elif kind == 'alias':
+            return htf_table(tex_name, value, {})
+        elif kind == 'footer':
+            break
+        elif kind == 'error':
+            raise ValueError(htf_file + ':' + str(number) + ': ' + value)
+    return htf_table(tex_name, None, chars)
+
+
+def _entity_problems(text):
+    """Yields the offsets of bad entities in the text of an .htf file and what's wrong with them.
+
+    Checking the whole file with a few regular expressions is much
+    faster than checking each line.
+    """
+    for match in _bad_entity_regex.finditer(text):
+        yield match.start(), 'malformed entity at ' + repr(text[match.start():match.start() + 10].split()[0])
+    for match in _invalid_entity_regex.finditer(text):
+        yield match.start(), 'entity ' + match.group() + " isn't a Unicode character"
+    for match in _decimal_entity_regex.finditer(text):
+        code_point = int(match.group(1))
+        if not 0 < code_point <= 0x10ffff or 0xd800 <= code_point <= 0xdfff:
+            yield match.start(), 'entity ' + match.group() + " isn't a Unicode character"
+
+
+def _alias_target(htf_file, aliases):
+    """Returns the name of the file an .htf file is an alias to, or None, remembering it in aliases."""
+    if htf_file not in aliases:
+        target = None
+        for number, kind, value in iter_htf(htf_file):
+            if kind == 'alias':
+                target = value
+            break
+        aliases[htf_file] = target
+    return aliases[htf_file]
+
+
+@_stage('validate_htf')
+def validate_htf(htf_file, files = None, known = (), aliases = None):
+    """Checks an .htf file without TeX.
+
+    This checks the structure iter_htf() parses, that the footer is the
+    same as the header and the header names the file, that each
+    character line's position is the right one, that the strings only
+    contain well-formed entities for Unicode characters, and that
+    htfcss lines name fonts tex4ht will apply them to.  For an alias,
+    it follows the chain of aliases to a file with characters and
+    reports missing files and cycles.
+
+    Args:
+        htf_file: The name of an .htf file.
+        files: A dictionary from .htf file names to paths to look
+            aliases up in, as locate_files() returns.  By default, the
+            files in the same directory as htf_file.
+        known: Names of .htf files (without '.htf') that count as
+            existing without being read, like HTFIndex.names.
+        aliases: A dictionary to remember which files are aliases in,
+            to share between calls.
+
+    Returns:
+        A list of problems as 'file:line: message' strings, empty if
+        the file is valid.
+    """
+    tex_name = os.path.splitext(os.path.basename(htf_file))[0]
+    if aliases is None:
+        aliases = {}
+    target = None
+    try:
+        with open(htf_file, encoding = 'latin-1') as htf:
+            text = htf.read()
+    except OSError as error:
+        return [htf_file + ': ' + str(error)]
+    # I check the entities in the whole file at once, then sort the
+    # problems with the others by line.
+    found = [(text.count('\n', 0, offset) + 1, problem) for offset, problem in _entity_problems(text)]
+    # Most files are written by write_htf() and valid, and checking
+    # those with regular expressions is much faster than parsing them
+    # line by line, so I only parse the files that don't pass.
+    written = _written_htf_regex.match(text)
+    if written and not found and written.group(1) == tex_name:
+        low, high = int(written.group(2)), int(written.group(3))
+        if (low <= high and _stated_position_regex.findall(written.group(4)) == [str(i) for i in range(low, high + 1)]
+                # As in iter_htf(), an htfcss line without a font name
+                # is an error, which the slow path reports.
+                and all(fields and fields[0].startswith(tex_name)
+                        for fields in (line[7:].split() for line in written.group(5).splitlines()))):
+            aliases[htf_file] = None
+            return []
+    for number, kind, value in iter_htf(text.split('\n')):
+        problem = None
+        if kind == 'character':
+            stated = value.rest.partition(' ')[0]
+            if stated != str(value.position) and stated.isdigit():
+                problem = 'the line for position ' + str(value.position) + ' says ' + stated
+        elif kind == 'header':
+            if value.tex_name != tex_name:
+                problem = 'the header names ' + value.tex_name + ', not ' + tex_name
+        elif kind == 'css':
+            # tex4ht only applies htfcss lines to fonts whose names
+            # start with the name of the .htf file.
+            if not value.tex_name.startswith(tex_name):
+                problem = "tex4ht won't apply the htfcss line for " + value.tex_name + ' in ' + tex_name + '.htf'
+        elif kind == 'alias':
+            target = value
+            if not target:
+                problem = 'alias without a name'
+        elif kind == 'error':
+            problem = value
+        if problem:
+            found.append((number, problem))
+    found.sort()
+    problems = [htf_file + ':' + str(number) + ': ' + problem for number, problem in found]
+    aliases[htf_file] = target
+
+    if files is None:
+        directory = os.path.dirname(htf_file) or '.'
+        files = {name: os.path.join(directory, name) for name in os.listdir(directory)
+                 if name.endswith('.htf')}
+    chain = [tex_name]
+    while target:
+        if target in chain:
+            problems.append(htf_file + ': alias cycle ' + ' -> '.join(chain + [target]))
+            break
+        chain.append(target)
+        path = files.get(target + '.htf')
+        if path is None:
+            if target not in known:
+                problems.append(htf_file + ': ' + ' -> '.join(chain) + ': no ' + target + '.htf')
+            break
+        try:
+            target = _alias_target(path, aliases)
+        except OSError as error:
+            problems.append(htf_file + ': ' + str(error))
+            break
+    return problems
+
+
+def validate_htfs(htf_files, search_path = (), known = ()):
+    """Checks many .htf files with validate_htf().
+
+    Aliases are looked up first among htf_files, then in search_path,
+    and each file in a chain of aliases is only read once.
+
+    Args:
+        htf_files: Names of .htf files and of directories to check the
+            .htf files in.
+        search_path: Directories with other .htf files aliases can
+            refer to, like tex4ht's ht-fonts.
+        known: Names of .htf files that count as existing without
+            being read, like HTFIndex.names.
+
+    Returns:
+        A dictionary from the names of the files with problems to lists
+        of their problems, and the number of files checked.
+    """
+    paths = []
+    for name in htf_files:
+        if os.path.isdir(name):
+            for root, dirs, names in os.walk(name):
+                dirs.sort()
+                paths.extend(os.path.join(root, file_name) for file_name in sorted(names)
+                             if file_name.endswith('.htf'))
+        else:
+            paths.append(name)
+    files = {}
+    for path in paths:
+        files.setdefault(os.path.basename(path), path)
+    for name, path in locate_files(search_path).items():
+        if name.endswith('.htf'):
+            files.setdefault(name, path)
+
+    aliases = {}
+    results = {}
+    for path in paths:
+        problems = validate_htf(path, files, known, aliases)
+        if problems:
+            results[path] = problems
+    return results, len(paths)
+
+
+class HTFIndex:
+    """An index of the .htf files installed with tex4ht.
+
+    scan() reads each .htf file in a directory tree like tex4ht's
+    ht-fonts once and indexes it by the htf_fingerprint() of its
+    characters, so a new font with the same characters as an installed
+    file can be written as an alias to it without writing its
+    characters.  written() returns a dictionary to pass to write_htf()
+    for that.  The index is stored as JSON, and files whose sizes and
+    modification times haven't changed aren't read again.
+
+    When several installed files have the same characters, the one
+    whose path sorts first is used.  Alias files are recorded but not
+    indexed, since the files they point to are.
+
+    Attributes:
+        index_file: The name of the JSON file, or None.
+        files: A dictionary from .htf file paths to lists of their
+            sizes, modification times, TeX names, and fingerprints
+            (None for aliases).
+        fingerprints: A dictionary from fingerprints to the TeX names
+            of the installed files with those characters.
+        names: The set of the TeX names of the installed files.
+    """
+
+    def __init__(self, index_file = None):
+        self.index_file = index_file
+        index = {}
+        if index_file:
+            try:
+                with open(index_file) as f:
+                    index = json.load(f)
+            except FileNotFoundError:
+                pass
+        self.files = index.get('files', {}) if index.get('version') == __version__ else {}
+        self._update()
+
+    def _update(self):
+        self.fingerprints = {}
+        self.names = set()
+        for path in sorted(self.files):
+            size, mtime, tex_name, fingerprint = self.files[path]
+            self.names.add(tex_name)
+            if fingerprint:
+                self.fingerprints.setdefault(fingerprint, tex_name)
+
+    def scan(self, directory):
+        """Indexes the .htf files in a directory tree, replacing any previous scan of it.
+
+        Returns:
+            The number of files read.
+        """
+        directory = os.path.abspath(directory)
+        found = {}
+        read = 0
+        for root, dirs, names in os.walk(directory):
+            for name in names:
+                if not name.endswith('.htf'):
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                known = self.files.get(path)
+                if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+                    found[path] = known
+                    continue
+                try:
+                    table = read_htf(path)
+                except (OSError, ValueError) as error:
+                    logging.error(str(error))
+                    continue
+                read += 1
+                tex_name = os.path.splitext(name)[0]
+                fingerprint = None if table.alias else htf_fingerprint(table.chars)
+                found[path] = [stat.st_size, stat.st_mtime_ns, tex_name, fingerprint]
+        prefix = os.path.join(directory, '')
+        self.files = {path: known for path, known in self.files.items() if not path.startswith(prefix)}
+        self.files.update(found)
+        self._update()
+        return read
+
+    def alias(self, chars):
+        """Returns the TeX name of an installed file with the same characters, or None."""
+        return self.fingerprints.get(htf_fingerprint(chars))
+
+    def encoding_alias(self, tex_name):
+        """Returns the installed file external_alias() would alias a font to, or None.
+
+        Unlike external_alias(), this returns None if the file for the
+        font's encoding isn't in the index.
+        """
+        tag = _encoding_tag(tex_name)
+        if tag and known_encodings[tag] in self.names:
+            return known_encodings[tag]
+        return None
+
+    def written(self):
+        """Returns a written dictionary for write_htf() that starts with the installed files.
+
+        The fingerprints of the files write_htf() writes are added to a
+        separate dictionary in front of the index, so the index itself
+        doesn't change.
+        """
+        return collections.ChainMap({}, self.fingerprints)
+
+    def save(self, index_file = None):
+        """Writes the index to index_file, or to the file it was loaded from."""
+        index_file = index_file or self.index_file
+        directory = os.path.dirname(os.path.abspath(index_file))
+        with tempfile.NamedTemporaryFile('w', dir = directory, suffix = '.tmp', delete = False) as f:
+            json.dump({'version': __version__, 'files': self.files}, f, indent = 1, sort_keys = True)
+        os.replace(f.name, index_file)
+
+
+# The named tuple for a character typeset by a virtual font: its
+# position in a real font and the real font's TeX name.
+vf_char = collections.namedtuple('vf_char', 'char_code tex_name')
+
+# The result of read_vf(), the same chars and fonts VFtoHTF builds.
+vf_font = collections.namedtuple('vf_font', 'chars fonts')
+
+
+def _dvi_parameter_lengths():
+    """Returns the number of parameter bytes after each DVI opcode read_vf() skips.
+
+    The opcodes read_vf() has to look at (setting and putting
+    characters, changing fonts, specials, and font definitions) and
+    opcodes that can't appear in a VF packet are None.
+    """
+    lengths = [None] * 256
+    # set_rule and put_rule
+    lengths[132] = lengths[137] = 8
+    # nop, bop, eop, push, and pop
+    lengths[138] = 0
+    lengths[139] = 44
+    lengths[140] = lengths[141] = lengths[142] = 0
+    # right1-4, w0-4, x0-4, down1-4, y0-4, and z0-4
+    for first, has_zero in ((143, False), (147, True), (152, True), (157, False), (161, True), (166, True)):
+        if has_zero:
+            lengths[first] = 0
+            first += 1
+        for n in range(4):
+            lengths[first + n] = n + 1
+    return tuple(lengths)
+
+
+_dvi_lengths = _dvi_parameter_lengths()
+
+
+def _read_int(data, offset, n):
+    """Reads an n-byte big-endian integer, signed only if n is 4, as in DVI files."""
+    if n == 1:
+        return data[offset]
+    if n == 2:
+        return data[offset] << 8 | data[offset + 1]
+    if n == 3:
+        return data[offset] << 16 | data[offset + 1] << 8 | data[offset + 2]
+    return struct.unpack_from('>i', data, offset)[0]
+
+
+@_stage('read_vf')
+def read_vf(vf_file):
+    """Reads the characters in a virtual font straight from a VF file.
+
+    The format description for VF files is in vftovp.web:
+    https://www.ctan.org/pkg/vftovp
+
+    This does the same job as VFtoHTF without dvilike or Construct.
+    It scans the bytes of the file, skipping every DVI command that
+    only moves the reference point by its known length, and only
+    builds objects for the characters and fonts.
+
+    Args:
+        vf_file: The name of a VF file or a readable binary file object.
+
+    Returns:
+        A vf_font named tuple with the same chars and fonts attributes
+        a VFtoHTF instance has after processing the VF file.
+    """
+    if isinstance(vf_file, str):
+        with open(vf_file, 'rb') as f:
+            data = f.read()
+    else:
+        data = vf_file.read()
+    data = memoryview(data)
+
+    if data[0] != 247 or data[1] != 202:
+        raise ValueError("not a VF file")
+    # Skip the comment, checksum, and design size.
+    offset = 3 + data[2] + 8
+
+    chars = collections.defaultdict(list)
+    fonts = {}
+    default_font = None
+    lengths = _dvi_lengths
+    while True:
+        opcode = data[offset]
+        if 243 <= opcode <= 246:
+            # fnt_def1-4: the font number, checksum, scaled size,
+            # design size, and the lengths of the area and the name.
+            n = opcode - 242
+            font_num = _read_int(data, offset + 1, n)
+            offset += 1 + n + 12
+            area = data[offset]
+            length = data[offset + 1]
+            offset += 2 + area
+            tex_name = bytes(data[offset:offset + length]).decode('latin-1')
+            offset += length
+            if default_font is None:
+                default_font = tex_name
+            fonts[font_num] = tex_name
+            continue
+        if opcode == 248:
+            break
+        if opcode == 242:
+            # long_char: the packet length, character code, and width.
+            packet_length, char_code = struct.unpack_from('>II', data, offset + 1)
+            offset += 13
+        elif opcode < 242:
+            # short_char: the opcode is the packet length.
+            packet_length = opcode
+            char_code = data[offset + 1]
+            offset += 5
+        else:
+            raise ValueError('unexpected opcode ' + str(opcode) + ' at byte ' + str(offset))
+
+        end = offset + packet_length
+        current_font = default_font
+        typeset = chars[char_code]
+        while offset < end:
+            opcode = data[offset]
+            offset += 1
+            if opcode < 128:
+                # set_char_0-127
+                typeset.append(vf_char(opcode, current_font))
+                continue
+            length = lengths[opcode]
+            if length is not None:
+                offset += length
+            elif opcode <= 136:
+                # set1-4 and put1-4
+                n = opcode - 127 if opcode <= 131 else opcode - 132
+                typeset.append(vf_char(_read_int(data, offset, n), current_font))
+                offset += n
+            elif 171 <= opcode <= 234:
+                # fnt_num_0-63
+                current_font = fonts[opcode - 171]
+            elif 235 <= opcode <= 238:
+                # fnt1-4
+                n = opcode - 234
+                current_font = fonts[_read_int(data, offset, n)]
+                offset += n
+            elif 239 <= opcode <= 242:
+                # xxx1-4, specials, which are skipped along with their
+                # contents.
+                n = opcode - 238
+                offset += n + _read_int(data, offset, n)
+            else:
+                raise ValueError('unexpected opcode ' + str(opcode) + ' in the packet for character ' + str(char_code))
+        # Packets can be empty, but VFtoHTF doesn't record those.
+        if not typeset:
+            del chars[char_code]
+    data.release()
+    if profiler is not None:
+        profiler.count('vf_characters', len(chars))
+    return vf_font(chars, fonts)
+
+
+class VFResolver:
+    """Builds character tables for virtual fonts from the real fonts they use.
+
+    A virtual font only says which characters of which real fonts it
+    typesets at each position.  To write an .htf file for it, each of
+    those real fonts has to be found through its map entry and read
+    with get_characters().  A resolver does this and remembers every
+    real font it reads, so that each one is read only once however
+    many virtual fonts use it, as with the families of *-ot1.vf and
+    *-t1.vf files built on the same base fonts.  Real fonts that are
+    themselves virtual fonts, with a VF file in the search path but no
+    map entry, are resolved the same way.
+
+    Attributes:
+        fonts: A dictionary (or anything with a get() method) from TeX
+            names to map entries.
+        files: A dictionary from file names to paths, as
+            locate_files() returns.
+        backend: The get_characters() backend to read fonts with.
+        cache: A CharacterCache, or None.
+    """
+
+    def __init__(self, fonts, search_path = ('.',), backend = 'fontforge', cache = None, files = None):
+        """Indexes the map entries and the files in the search path.
+
+        Args:
+            fonts: The map entries parse_map() or iter_map() return,
+                or a dictionary from TeX names to map entries.  If a
+                TeX name appears more than once, the first entry wins.
+            search_path: A list of directories to search for glyph,
+                encoding, and VF files.
+            backend: The get_characters() backend to read fonts with.
+            cache: A CharacterCache to look fonts up in first.
+            files: A dictionary from file names to paths, as
+                locate_files() returns, to use instead of walking
+                search_path.
+        """
+        if hasattr(fonts, 'get'):
+            self.fonts = fonts
+        else:
+            self.fonts = {}
+            for font in fonts:
+                self.fonts.setdefault(font.tex_name, font)
+        self.files = locate_files(search_path) if files is None else files
+        self.backend = backend
+        self.cache = cache
+        self._real_fonts = {}
+        # The virtual fonts being resolved, to catch ones that use
+        # themselves.
+        self._resolving = set()
+
+    def real_characters(self, tex_name):
+        """Returns the characters in a real font, reading it only the first time.
+
+        Raises:
+            LookupError: There's no map entry with a glyph file and no
+                VF file for the font.
+        """
+        if tex_name in self._real_fonts:
+            return self._real_fonts[tex_name]
+        font = self.fonts.get(tex_name)
+        if font and font.type1_name:
+            if font.type1_name not in self.files:
+                raise LookupError("couldn't find " + font.type1_name + ' for ' + tex_name)
+            if font.enc_name and font.enc_name not in self.files:
+                raise LookupError("couldn't find " + font.enc_name + ' for ' + tex_name)
+            font_file = self.files[font.type1_name]
+            enc_file = self.files.get(font.enc_name)
+            if self.cache:
+                chars = self.cache.get_characters(font_file, enc_file, self.backend)
+            else:
+                chars = get_characters(font_file, enc_file, self.backend)
+        elif tex_name + '.vf' in self.files and tex_name not in self._resolving:
+            chars = self.resolve(self.files[tex_name + '.vf'], tex_name)
+        else:
+            raise LookupError("couldn't find a map entry or VF file for " + tex_name)
+        self._real_fonts[tex_name] = chars
+        return chars
+
+    @_stage('VFResolver.resolve')
+    def resolve(self, vf_file, tex_name = None):
+        """Returns the characters in a virtual font in the format write_htf() accepts.
+
+        Characters the virtual font builds from several real
+        characters get the Unicode sequence of those characters as a
+        string, with their glyph names joined by underscores, unless
+        one of them has no code point, in which case the whole
+        character is pictorial.  Real characters missing from their
+        fonts are left out.
+
+        Args:
+            vf_file: The name of a VF file.
+            tex_name: The TeX name of the virtual font, by default the
+                name of the VF file without '.vf'.
+        """
+        if tex_name is None:
+            tex_name = os.path.splitext(os.path.basename(vf_file))[0]
+        self._resolving.add(tex_name)
+        try:
+            vf = read_vf(vf_file)
+            chars = CharacterTable()
+            for position, typeset in sorted(vf.chars.items()):
+                if position > 255:
+                    if profiler is not None:
+                        profiler.count('vf_positions_above_255_skipped')
+                    continue
+                parts = []
+                for part in typeset:
+                    real = self.real_characters(part.tex_name).get(part.char_code)
+                    if real:
+                        parts.append(real)
+                if len(parts) == 1:
+                    chars[position] = parts[0]
+                elif parts:
+                    name = '_'.join(part.name for part in parts)
+                    if any(part.code_point == -1 for part in parts):
+                        chars[position] = character(-1, name)
+                    else:
+                        chars[position] = character(''.join(chr(part.code_point) if type(part.code_point) == int else part.code_point
+                                                            for part in parts), name)
+        finally:
+            self._resolving.discard(tex_name)
+        return chars
 
 
 class VFtoHTF(OpcodeCommandsMachine):
@@ -300,11 +2581,13 @@ class VFtoHTF(OpcodeCommandsMachine):
         TeX name for a character in a real font; and _default_font,
         the name of the font that appears first in the VF file.
         """
+        if VFProcessor is None:
+            raise ImportError('VFtoHTF requires dvilike, https://github.com/ceridwen/dvilike')
         super().__init__()
         self._commands['put'] = self.set
         self.fonts = {}
         self.chars = collections.defaultdict(list)
-        self.vf_char = collections.namedtuple('vf_char', 'char_code tex_name')
+        self.vf_char = vf_char
         self._default_font = None
 
     def _vf_char(self, char_code):
@@ -312,6 +2595,7 @@ class VFtoHTF(OpcodeCommandsMachine):
         """
         return self.vf_char(char_code, self._current_font)
 
+    @_stage('VFtoHTF.fnt_def')
     def fnt_def(self, container):
         """Sets the default font to the first font and defines all the fonts.
 
@@ -323,6 +2607,7 @@ class VFtoHTF(OpcodeCommandsMachine):
             self._default_font = container.tex_name
         self.fonts[container.font_num] = container.tex_name
 
+    @_stage('VFtoHTF.char')
     def char(self, container):
         """Defines which VF character is being typeset and recurses on the DVI code.
 
@@ -338,15 +2623,20 @@ class VFtoHTF(OpcodeCommandsMachine):
         """
         self._current_font = self._default_font
         self._current_char = container.char_code
+        if profiler is not None:
+            profiler.count('vf_characters')
         for dvi_container in container.dvi_code:
             self(dvi_container)
 
+    @_stage('VFtoHTF.fnt')
     def fnt(self, container):
         self._current_font = self.fonts[container.font_num]
 
+    @_stage('VFtoHTF.set_char')
     def set_char(self, container):
         self.chars[self._current_char].append(self._vf_char(container.opcode))
 
+    @_stage('VFtoHTF.set')
     def set(self, container):
         self.chars[self._current_char].append(self._vf_char(container.char_code))
 
@@ -380,81 +2670,849 @@ class VFtoHTF(OpcodeCommandsMachine):
         pass
 
 
+class BuildManifest:
+    """Records the inputs each generated .htf file was built from.
+
+    For each .htf file, the manifest keeps the map entry, the glyph,
+    encoding, and VF files it was generated from with their sizes,
+    modification times, and SHA-256 hashes, and the CSS font_css gave
+    the font.  A file only has to be regenerated if one of these
+    changed.  Files whose sizes and modification times are the same as
+    last time aren't hashed again.  The manifest is stored as JSON and
+    saved by renaming a temporary file, like CharacterCache entries.
+
+    Attributes:
+        manifest_file: The name of the JSON file.
+        outputs: A dictionary from .htf file names (without their
+            directory) to records, as record() returns them.
+    """
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        try:
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {}
+        # A manifest from another version of the library doesn't say
+        # anything about what this version would generate.
+        if manifest.get('version') == __version__:
+            self.outputs = manifest['outputs']
+        else:
+            self.outputs = {}
+        self._hashes = {}
+        for record in self.outputs.values():
+            for path, stat in record['inputs'].items():
+                self._hashes[path] = stat
+
+    def file_stat(self, path):
+        """Returns a list of the size, modification time, and SHA-256 hash of a file."""
+        stat = os.stat(path)
+        known = self._hashes.get(path)
+        if not (known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns):
+            known = [stat.st_size, stat.st_mtime_ns, _file_digest(path).hex()]
+            self._hashes[path] = known
+        return known
+
+    def record(self, entry, input_files, css = None):
+        """Returns the record for an .htf file.
+
+        Args:
+            entry: The map entry for the font, or None for a virtual
+                font.
+            input_files: The paths of the files the .htf file is
+                generated from.
+            css: The CSS properties for the font, if any.
+        """
+        return {'entry': list(entry) if entry else None,
+                'inputs': {path: self.file_stat(path) for path in sorted(input_files)},
+                'css': css}
+
+    def changed(self, htf_name, record):
+        """Whether the .htf file's record differs from the one in the manifest."""
+        old = self.outputs.get(htf_name)
+        # Only the hashes matter, not the sizes and modification times.
+        return (not old or old['entry'] != record['entry'] or old['css'] != record['css']
+                or {path: stat[2] for path, stat in old['inputs'].items()}
+                != {path: stat[2] for path, stat in record['inputs'].items()})
+
+    def save(self):
+        """Writes the manifest to manifest_file."""
+        directory = os.path.dirname(os.path.abspath(self.manifest_file))
+        with tempfile.NamedTemporaryFile('w', dir = directory, suffix = '.tmp', delete = False) as f:
+            json.dump({'version': __version__, 'outputs': self.outputs}, f, indent = 1, sort_keys = True)
+        os.replace(f.name, self.manifest_file)
+
+
+# The result of rebuild(): lists of the TeX names of the fonts whose
+# .htf files were written, were left alone, and were deleted, and a
+# list of batch_result named tuples for the fonts that failed.
+rebuild_result = collections.namedtuple('rebuild_result', 'written unchanged deleted errors')
+
+
+def _vf_inputs(vf_file, fonts, files, inputs):
+    """Adds the paths of a VF file and of everything its fonts come from to inputs."""
+    inputs.add(vf_file)
+    for tex_name in read_vf(vf_file).fonts.values():
+        font = fonts.get(tex_name)
+        if font and font.type1_name:
+            for name in (font.type1_name, font.enc_name):
+                if name in files:
+                    inputs.add(files[name])
+        elif tex_name + '.vf' in files and files[tex_name + '.vf'] not in inputs:
+            _vf_inputs(files[tex_name + '.vf'], fonts, files, inputs)
+
+
+def rebuild(fonts, output_dir = '.', search_path = ('.',), vf_files = None, font_css = None,
+            manifest_file = None, workers = None, backend = 'fontforge', cache = None):
+    """Regenerates only the .htf files whose inputs changed since the last build.
+
+    Deciding what to regenerate only takes one scan of the output
+    directory, stat() calls on the inputs, and hashes of the inputs
+    whose sizes or modification times changed; no fonts are opened for
+    .htf files that are up to date.  .htf files in the manifest that
+    would no longer be generated are deleted.  Fonts that fail are
+    left out of the manifest, so they're tried again next time.  The
+    manifest describes everything one build generates, so builds of
+    different sets of fonts into the same directory need different
+    manifests.
+
+    Args:
+        fonts: The map entries parse_map() or iter_map() return, or
+            the name of a map file.
+        output_dir: The directory the .htf files are in.
+        search_path: A list of directories to search for glyph,
+            encoding, and VF files.
+        vf_files: If None, an .htf file is built for each font in
+            fonts, as write_htfs() does.  Otherwise, a list of VF
+            files to build .htf files for, and fonts is only used to
+            look up the real fonts they use.
+        font_css: A function that takes a TeX name and returns CSS
+            font properties for the font, as for variant_aliases(),
+            or None.
+        manifest_file: The name of the manifest, by default
+            .htf-manifest.json in output_dir.
+        workers: The number of processes write_htfs() uses.
+        backend: The get_characters() backend to read fonts with.
+        cache: A CharacterCache to look fonts up in first.
+
+    Returns:
+        A rebuild_result named tuple.
+    """
+    if isinstance(fonts, str):
+        fonts = list(iter_map(fonts))
+    # As in write_htfs(), the first entry for a TeX name wins.
+    first = {}
+    for font in fonts:
+        if font.tex_name:
+            first.setdefault(font.tex_name, font)
+    fonts = list(first.values())
+    if manifest_file is None:
+        manifest_file = os.path.join(output_dir, '.htf-manifest.json')
+    manifest = BuildManifest(manifest_file)
+    files = locate_files(search_path)
+    if font_css:
+        # The CSS goes in the manifest records and in the .htf files,
+        # so I only compute it once for each font.
+        font_css = functools.lru_cache(maxsize = None)(font_css)
+    os.makedirs(output_dir, exist_ok = True)
+    with os.scandir(output_dir) as scan:
+        existing = {entry.name for entry in scan}
+
+    # The records for all the .htf files that should exist, and the
+    # fonts or VF files whose .htf files have to be regenerated.
+    records = {}
+    stale = []
+    stale_names = []
+    errors = []
+    if vf_files is None:
+        for font in fonts:
+            htf_name = font.tex_name + '.htf'
+            inputs = [files[name] for name in (font.type1_name, font.enc_name) if name in files]
+            records[htf_name] = manifest.record(font, inputs, font_css(font.tex_name) if font_css else None)
+            if htf_name not in existing or manifest.changed(htf_name, records[htf_name]):
+                stale.append(font)
+                stale_names.append(font.tex_name)
+    else:
+        entries = {}
+        for font in fonts:
+            entries.setdefault(font.tex_name, font)
+        for vf_file in vf_files:
+            tex_name = os.path.splitext(os.path.basename(vf_file))[0]
+            htf_name = tex_name + '.htf'
+            inputs = set()
+            try:
+                _vf_inputs(vf_file, entries, files, inputs)
+            except (LookupError, OSError, ValueError) as error:
+                logging.error(tex_name + ': ' + str(error))
+                errors.append(batch_result(tex_name, os.path.join(output_dir, htf_name), str(error), None))
+                continue
+            records[htf_name] = manifest.record(None, inputs, font_css(tex_name) if font_css else None)
+            if htf_name not in existing or manifest.changed(htf_name, records[htf_name]):
+                stale.append(vf_file)
+                stale_names.append(tex_name)
+
+    # The search path was walked once above, and nothing else needs
+    # to happen when nothing is stale.
+    if vf_files is None:
+        if stale:
+            results = write_htfs(stale, output_dir, search_path, workers, True, backend, cache,
+                                 font_css = font_css, files = files)
+            errors.extend(result for result in results if result.error)
+    elif stale:
+        resolver = VFResolver(fonts, search_path, backend, cache, files)
+        for vf_file in stale:
+            tex_name = os.path.splitext(os.path.basename(vf_file))[0]
+            htf_file = os.path.join(output_dir, tex_name + '.htf')
+            try:
+                chars = resolver.resolve(vf_file)
+                if not chars:
+                    raise ValueError('no characters at positions 0-255')
+            except (LookupError, OSError, ValueError) as error:
+                logging.error(tex_name + ': ' + str(error))
+                errors.append(batch_result(tex_name, htf_file, str(error), None))
+                continue
+            with open(htf_file, 'w') as htf:
+                write_htf(chars, tex_name, htf)
+                if font_css:
+                    variant_aliases([tex_name], font_css, htf)
+    failed = {result.tex_name + '.htf' for result in errors}
+
+    deleted = []
+    # VF files that couldn't be read have no records, but their .htf
+    # files are kept until they can be.
+    for htf_name in sorted(set(manifest.outputs) - set(records) - failed):
+        if htf_name in existing:
+            os.remove(os.path.join(output_dir, htf_name))
+        deleted.append(htf_name[:-4])
+        del manifest.outputs[htf_name]
+    for htf_name in failed:
+        manifest.outputs.pop(htf_name, None)
+    for htf_name, record in records.items():
+        if htf_name not in failed:
+            manifest.outputs[htf_name] = record
+    manifest.save()
+
+    written = [tex_name for tex_name in stale_names if tex_name + '.htf' not in failed]
+    unchanged = sorted(set(htf_name[:-4] for htf_name in records) - set(stale_names))
+    return rebuild_result(written, unchanged, deleted, errors)
+
+
+class _CharacterMemo:
+    """Keeps the characters of recently read fonts in memory for a service worker.
+
+    An entry is used only while the font and encoding files have the
+    same sizes and modification times as when it was read.  This has
+    the get_characters() method of CharacterCache, so a VFResolver can
+    use it as its cache.
+    """
+
+    def __init__(self, cache = None, max_fonts = 1024):
+        self.cache = cache
+        self.max_fonts = max_fonts
+        self._fonts = collections.OrderedDict()
+
+    def get_characters(self, font_file, enc_file = None, backend = 'fontforge'):
+        """Works like get_characters(), but remembers the result."""
+        stats = tuple((stat.st_size, stat.st_mtime_ns)
+                      for stat in map(os.stat, filter(None, (font_file, enc_file))))
+        key = font_file, enc_file, backend
+        entry = self._fonts.get(key)
+        if entry and entry[0] == stats:
+            self._fonts.move_to_end(key)
+            return entry[1]
+        if self.cache:
+            chars = self.cache.get_characters(font_file, enc_file, backend)
+        else:
+            chars = get_characters(font_file, enc_file, backend)
+        self._fonts[key] = stats, chars
+        if len(self._fonts) > self.max_fonts:
+            self._fonts.popitem(last = False)
+        return chars
+
+
+# The state of a service worker process, set by _start_service_worker().
+_service_worker = None
+
+
+def _start_service_worker(search_path, fonts, backend, cache, font_css, output_dir):
+    """Sets up a worker process for HTFService."""
+    global _service_worker
+    import signal
+    # Interrupting the service stops it through the parent process.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if backend == 'fontforge':
+        # Importing FontForge is slow, so each worker does it once,
+        # before its first job.
+        with contextlib.suppress(ImportError):
+            import fontforge
+    memo = _CharacterMemo(cache)
+    resolver = VFResolver(fonts, search_path, backend, memo)
+    _service_worker = {'resolver': resolver, 'memo': memo, 'font_css': font_css, 'output_dir': output_dir}
+
+
+def _service_path(resolver, name):
+    """Returns name if it's a path, or else the path of the file with that name in the search path."""
+    if name is None or os.path.dirname(name) or name not in resolver.files:
+        return name
+    return resolver.files[name]
+
+
+def _service_characters(request):
+    """Returns the characters for a characters or write_htf request."""
+    resolver = _service_worker['resolver']
+    if 'chars' in request:
+        return CharacterTable((int(position), character(*value)) for position, value in request['chars'].items())
+    if 'vf_file' in request:
+        # The resolver keeps the real fonts it reads, but they might
+        # have changed since the last request.  The memo checks.
+        resolver._real_fonts.clear()
+        vf_file = _service_path(resolver, request['vf_file'])
+        return resolver.resolve(vf_file, request.get('tex_name'))
+    if 'font_file' in request:
+        return _service_worker['memo'].get_characters(_service_path(resolver, request['font_file']),
+                                                      _service_path(resolver, request.get('enc_file')),
+                                                      request.get('backend', resolver.backend))
+    if 'tex_name' in request:
+        resolver._real_fonts.clear()
+        return resolver.real_characters(request['tex_name'])
+    raise ValueError('the request needs chars, vf_file, font_file, or tex_name')
+
+
+def _service_job(request):
+    """Runs one HTFService request in a worker process and returns the response."""
+    response = {'id': request.get('id')}
+    try:
+        op = request.get('op')
+        if op in ('characters', 'vf'):
+            chars = _service_characters(request)
+            response['result'] = {position: list(char) for position, char in chars.items()}
+        elif op == 'write_htf':
+            tex_name = request['tex_name']
+            htf_file = request.get('htf_file') or os.path.join(request.get('output_dir', _service_worker['output_dir']),
+                                                               tex_name + '.htf')
+            if not request.get('force') and os.path.exists(htf_file):
+                raise ValueError("didn't overwrite " + htf_file)
+            chars = _service_characters(request)
+            if not chars:
+                raise ValueError('no characters at positions 0-255')
+            font_css = _service_worker['font_css']
+            if 'css' in request:
+                font_css = lambda name: request['css']
+            with open(htf_file, 'w') as htf:
+                write_htf(chars, tex_name, htf)
+                if font_css:
+                    variant_aliases([tex_name], font_css, htf)
+            response['result'] = {'htf_file': htf_file}
+        else:
+            raise ValueError('unknown op ' + repr(op))
+    except KeyError as error:
+        response['error'] = 'missing ' + str(error)
+    except Exception as error:
+        response['error'] = type(error).__name__ + ': ' + str(error)
+    return response
+
+
+class HTFService:
+    """Runs requests for characters and .htf files in a pool of long-lived processes.
+
+    Starting Python, importing FontForge, and locating the files in a
+    TeX tree take longer than reading most fonts, so a build system
+    that calls htf.py for every font package spends most of its time
+    starting up.  A service starts the worker processes once, and each
+    worker keeps FontForge imported, the parsed encodings, the map
+    entries, the files in the search path, and the characters of the
+    fonts it has read, until a font file changes.  Requests run in
+    parallel, up to the number of workers.
+
+    Requests and responses are JSON objects.  A request has an 'id',
+    which its response repeats, and an 'op':
+
+        characters: The characters of a font, given by 'font_file' and
+            optionally 'enc_file' and 'backend', or by 'tex_name' to
+            look the font up in the map files.  File names without a
+            directory are looked up in the search path.
+        vf: The characters of the virtual font 'vf_file', resolved
+            through the map files as VFResolver does.
+        write_htf: Writes an .htf file for 'tex_name' to 'htf_file' or
+            to 'output_dir' (by default the service's), with the characters given as for
+            characters or vf, or directly as 'chars'.  It doesn't
+            overwrite files unless 'force' is true.  'css' overrides
+            the CSS the service's font_css gives the font.
+
+    Characters are JSON objects from positions to lists of a code
+    point and a glyph name, as in CharacterCache.  A response has
+    either a 'result' or an 'error' message.
+
+    Attributes:
+        workers: The maximum number of worker processes.
+    """
+
+    def __init__(self, fonts = (), search_path = ('.',), backend = 'fontforge', cache = None,
+                 font_css = None, output_dir = '.', workers = None):
+        """Starts the worker processes.
+
+        Args:
+            fonts: The map entries for the fonts the requests can
+                name, as for VFResolver.
+            search_path: A list of directories to search for glyph,
+                encoding, and VF files.
+            backend: The default get_characters() backend.
+            cache: A CharacterCache the workers share, or None.
+            font_css: A function that takes a TeX name and returns CSS
+                font properties for it, as for variant_aliases().  It
+                has to be a module-level function, so that it can be
+                sent to the workers.
+            output_dir: The directory write_htf requests write to if
+                they don't say.
+            workers: The number of processes, by default the number of
+                CPUs.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self._initargs = (list(search_path), list(fonts), backend, cache, font_css, output_dir)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._executor = self._start(self.workers)
+        # A single worker that reruns the requests that were running
+        # when a worker died, one at a time, to find the one that
+        # killed it.  It's only started when it's needed.
+        self._alone = None
+        self._retries = collections.deque()
+        self._retrying = False
+        # Set while no requests are waiting to be run again.
+        self._idle = threading.Event()
+        self._idle.set()
+
+    def _start(self, workers):
+        """Returns a new pool of worker processes."""
+        return concurrent.futures.ProcessPoolExecutor(workers, initializer = _start_service_worker,
+                                                      initargs = self._initargs)
+
+    def _replace(self, executor):
+        """Replaces a broken pool with a new one, unless another thread already has."""
+        with self._lock:
+            if executor is self._executor:
+                self._executor = self._start(self.workers)
+            elif executor is self._alone:
+                self._alone = self._start(1)
+            else:
+                return
+        executor.shutdown(wait = False)
+
+    def submit(self, request):
+        """Starts a request.
+
+        When a worker dies, as FontForge can on a broken font, every
+        request running in the pool fails with it.  Those requests are
+        run again one at a time in a separate worker, so only the
+        request that killed the worker gets an error, and the pool is
+        replaced.
+
+        Returns:
+            A Future whose result is the response.
+        """
+        future = concurrent.futures.Future()
+        if not isinstance(request, dict):
+            future.set_result({'id': None, 'error': 'requests must be JSON objects'})
+        else:
+            self._run(request, future)
+        return future
+
+    def _run(self, request, future):
+        """Runs a request in the pool and answers it in future."""
+        executor = self._executor
+        try:
+            job = executor.submit(_service_job, request)
+        except (concurrent.futures.process.BrokenProcessPool, RuntimeError) as error:
+            if self._closed:
+                future.set_result({'id': request.get('id'), 'error': type(error).__name__ + ': ' + str(error)})
+                return
+            # The pool broke, or was replaced and shut down, after I
+            # looked it up.
+            self._replace(executor)
+            self._run(request, future)
+            return
+
+        def done(job):
+            try:
+                future.set_result(job.result())
+            except concurrent.futures.process.BrokenProcessPool:
+                self._replace(executor)
+                with self._lock:
+                    self._retries.append((request, future))
+                    start = not self._retrying
+                    self._retrying = True
+                    self._idle.clear()
+                if start:
+                    self._retry()
+            except Exception as error:
+                future.set_result({'id': request.get('id'), 'error': type(error).__name__ + ': ' + str(error)})
+
+        job.add_done_callback(done)
+
+    def _retry(self):
+        """Runs the next request that was in a pool when a worker died alone in its own worker."""
+        with self._lock:
+            if not self._retries:
+                self._retrying = False
+                self._idle.set()
+                return
+            request, future = self._retries.popleft()
+            if self._alone is None:
+                self._alone = self._start(1)
+            alone = self._alone
+
+        def done(job):
+            try:
+                future.set_result(job.result())
+            except concurrent.futures.process.BrokenProcessPool:
+                self._replace(alone)
+                future.set_result({'id': request.get('id'),
+                                   'error': 'the worker process died while answering the request'})
+            except Exception as error:
+                future.set_result({'id': request.get('id'), 'error': type(error).__name__ + ': ' + str(error)})
+            self._retry()
+
+        try:
+            job = alone.submit(_service_job, request)
+        except (concurrent.futures.process.BrokenProcessPool, RuntimeError) as error:
+            future.set_result({'id': request.get('id'), 'error': type(error).__name__ + ': ' + str(error)})
+            self._retry()
+            return
+        job.add_done_callback(done)
+
+    def serve(self, requests, responses):
+        """Answers JSON-lines requests until the end of the input.
+
+        Responses are written as soon as they're ready, so they can
+        come back in a different order than the requests.
+
+        Args:
+            requests: A text file object, or any other iterable of
+                lines, with one JSON request on each line.
+            responses: A writeable text file object for the responses,
+                one on each line.
+        """
+        lock = threading.Lock()
+        # The number of requests without a response yet.
+        pending = [0]
+        answered = threading.Condition(lock)
+
+        def respond(future):
+            try:
+                response = future.result()
+            except Exception as error:
+                # submit() answers every request, so this shouldn't
+                # happen.
+                response = {'id': future.request_id, 'error': type(error).__name__ + ': ' + str(error)}
+            with lock:
+                responses.write(json.dumps(response) + '\n')
+                responses.flush()
+                pending[0] -= 1
+                answered.notify()
+
+        for line in requests:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as error:
+                request = None
+                future = concurrent.futures.Future()
+                future.set_result({'id': None, 'error': 'invalid JSON: ' + str(error)})
+            else:
+                future = self.submit(request)
+            future.request_id = request.get('id') if isinstance(request, dict) else None
+            with lock:
+                pending[0] += 1
+            future.add_done_callback(respond)
+        with lock:
+            answered.wait_for(lambda: not pending[0])
+
+    def serve_socket(self, socket_file):
+        """Answers JSON-lines requests on a Unix socket until interrupted.
+
+        Each connection is served as serve() serves a file, and
+        connections are served at the same time, sharing the workers.
+        """
+        import socketserver
+
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                requests = (line.decode('utf-8') for line in self.rfile)
+                responses = io.TextIOWrapper(self.wfile, encoding = 'utf-8', write_through = True)
+                service.serve(requests, responses)
+                responses.detach()
+
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(socket_file)
+        with socketserver.ThreadingUnixStreamServer(socket_file, Handler) as server:
+            try:
+                server.serve_forever()
+            finally:
+                os.remove(socket_file)
+
+    def close(self):
+        """Waits for the running requests and stops the workers."""
+        self._closed = True
+        self._executor.shutdown()
+        self._idle.wait()
+        if self._alone:
+            self._alone.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main(argv = None):
+    """Handles the command line."""
+    import argparse
+    parser = argparse.ArgumentParser(description = 'This script generates virtual hypertext font files for use with TeX4ht from PostScript Font Binary glyph files, font encoding files, and virtual font files.')
+    parser.add_argument('-V', '--version', action = 'version', version = '%(prog)s ' + __version__, help = 'Print version information and exit.')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    # The options every subcommand shares.
+    profiling = argparse.ArgumentParser(add_help = False)
+    profiling.add_argument('--profile', metavar = 'FILE', help = 'Write the time spent in each stage and counts of fonts, glyphs, and bytes processed to FILE as JSON.')
+    profiling.add_argument('--trace', metavar = 'FILE', help = 'Write a Chrome trace-event file of the stages to FILE, for chrome://tracing or https://ui.perfetto.dev.')
+
+    # The options the subcommands that write .htf files share.
+    common = argparse.ArgumentParser(add_help = False, parents = [profiling])
+    common.add_argument('-p', '--search_path', nargs = '+', default = ['.'], help = 'Directories to search for glyph, encoding, and VF files.  The default is the current directory.')
+    common.add_argument('-o', '--output_dir', default = '.', help = 'The directory to write .htf files to.  The default is the current directory.')
+    common.add_argument('-b', '--backend', choices = sorted(character_backends), default = 'fontforge', help = "How to read glyph files: with FontForge or with htf.py's own Type 1 reader.  The default is fontforge.")
+    common.add_argument('-c', '--cache', help = 'A directory to cache the characters read from fonts in, so that unchanged fonts are only read once.')
+    common.add_argument('--cache_size', type = int, default = 64, help = 'The size limit of the cache in megabytes.  The default is 64.')
+    common.add_argument('--css', help = "A function that takes a font's TeX name and returns CSS font properties for it, as MODULE:FUNCTION.  The module is imported from the current directory or the Python path.")
+    common.add_argument('-q', '--quiet', action = 'store_true', help = "Don't print non-error messages.")
+
+    # The options for the subcommands that don't keep track of what
+    # they wrote before.
+    writing = argparse.ArgumentParser(add_help = False)
+    writing.add_argument('-f', '--force', action = 'store_true', help = 'Overwrite existing files.')
+    writing.add_argument('-d', '--deduplicate', action = 'store_true', help = 'Write an alias instead of the characters for fonts with the same characters as a font written earlier.')
+    writing.add_argument('-i', '--index', help = 'An index of installed .htf files made with the index command.  Fonts with the same characters as an installed file are written as aliases to it.')
+
+    batch = subparsers.add_parser('batch', parents = [common, writing], help = 'Generate an .htf file for every font in map files.', description = 'Generates an .htf file for every font in one or more map files, reading the fonts in parallel processes.  Glyph and encoding files are looked up by name in the search path.')
+    batch.add_argument('map_file', nargs = '+', help = 'The name(s) of map file(s).')
+    batch.add_argument('-j', '--jobs', type = int, help = 'The number of worker processes.  The default is the number of CPUs.')
+
+    vf = subparsers.add_parser('vf', parents = [common, writing], help = 'Generate .htf files for virtual fonts.', description = 'Generates an .htf file for each virtual font file, looking the real fonts it uses up in map files.  Each real font is only read once.')
+    vf.add_argument('vf_file', nargs = '+', help = 'The name(s) of VF file(s).')
+    real_fonts = vf.add_mutually_exclusive_group(required = True)
+    real_fonts.add_argument('-m', '--map_file', nargs = '+', help = 'The name(s) of map file(s) with the real fonts.')
+    real_fonts.add_argument('--map_index', help = 'A map index made with the maps command to look the real fonts up in, instead of map files.')
+
+    rebuild_parser = subparsers.add_parser('rebuild', parents = [common], help = 'Regenerate only the .htf files whose inputs changed.', description = "Regenerates the .htf files in the output directory whose map entries, glyph, encoding, or VF files, or CSS changed since the last rebuild, according to a manifest in the output directory, and deletes the .htf files that wouldn't be generated anymore.  Without --vf_file, it builds an .htf file for every font in the map files.")
+    rebuild_parser.add_argument('-m', '--map_file', nargs = '+', required = True, help = 'The name(s) of map file(s).')
+    rebuild_parser.add_argument('--vf_file', nargs = '+', help = 'Build .htf files for these VF files, using the map files to look up their real fonts.')
+    rebuild_parser.add_argument('--manifest', help = 'The name of the manifest file.  The default is .htf-manifest.json in the output directory.')
+    rebuild_parser.add_argument('-j', '--jobs', type = int, help = 'The number of worker processes.  The default is the number of CPUs.')
+
+    index_parser = subparsers.add_parser('index', parents = [profiling], help = 'Index the .htf files installed with tex4ht.', description = "Reads the .htf files in directory trees like tex4ht's ht-fonts and adds them to an index, so the batch and vf commands can write fonts with the same characters as aliases to them.  Files that haven't changed since the last time aren't read again.")
+    index_parser.add_argument('directory', nargs = '+', help = 'The directories to scan.')
+    index_parser.add_argument('-i', '--index', required = True, help = 'The index file to create or update.')
+    index_parser.add_argument('-q', '--quiet', action = 'store_true', help = "Don't print non-error messages.")
+
+    validate_parser = subparsers.add_parser('validate', parents = [profiling], help = 'Check .htf files without TeX.', description = "Checks the structure of .htf files, the entities in their strings, their htfcss lines, and that their aliases lead to files with characters, without running TeX.  Aliases are looked up among the files being checked, then in the search path.")
+    validate_parser.add_argument('htf_file', nargs = '+', help = 'The .htf files to check, or directories to check all the .htf files in.')
+    validate_parser.add_argument('-p', '--search_path', nargs = '+', default = [], help = "Directories with other .htf files that aliases can refer to, like tex4ht's ht-fonts.")
+    validate_parser.add_argument('-i', '--index', help = 'An index made with the index command.  Aliases to the files in it are valid.')
+    validate_parser.add_argument('-q', '--quiet', action = 'store_true', help = "Don't print non-error messages.")
+
+    serve = subparsers.add_parser('serve', parents = [common], help = 'Answer requests for characters and .htf files as a long-running service.', description = "Starts worker processes that keep FontForge, encodings, the files in the search path, and the fonts they've read loaded, then answers JSON requests, one per line, on standard input or a Unix socket.  See HTFService in htf.py for the requests.")
+    serve.add_argument('-m', '--map_file', nargs = '+', default = [], help = 'Map files with the fonts requests can name by TeX name or use in virtual fonts.')
+    serve.add_argument('-s', '--socket', help = 'Listen on this Unix socket instead of reading standard input.')
+    serve.add_argument('-j', '--jobs', type = int, help = 'The number of worker processes.  The default is the number of CPUs.')
+
+    maps = subparsers.add_parser('maps', parents = [profiling], help = 'Index the fonts in map files.', description = "Creates or updates an SQLite index of the fonts in map files, which the vf command can use instead of parsing map files, and looks fonts up in it.  Only the map files that changed since the last update are parsed again.  When a font appears more than once, the entry from the earliest map file wins, then the one on the earliest line.")
+    maps.add_argument('map_file', nargs = '*', help = 'Map files, or directories of them, in order of precedence.  If given, the index holds exactly these map files afterwards.')
+    maps.add_argument('-i', '--index', required = True, help = 'The index file to create, update, or search.')
+    maps.add_argument('-l', '--lookup', nargs = '+', default = [], help = 'Print the entries for these TeX or Postscript names, in order of precedence.')
+    maps.add_argument('-q', '--quiet', action = 'store_true', help = "Don't print non-error messages.")
+
+    variants = subparsers.add_parser('variants', parents = [profiling], help = 'Add htfcss lines for the variants of fonts to existing .htf files.', description = "Sorts the fonts in map files into the fewest .htf files tex4ht can find them in, each named after the shortest TeX name that's a prefix of the others, and appends htfcss lines with the CSS from --css for each font to them.  The .htf files must already exist in the output directory.")
+    variants.add_argument('map_file', nargs = '+', help = 'The name(s) of map file(s).')
+    variants.add_argument('--css', required = True, help = "A function that takes a font's TeX name and returns CSS font properties for it, as MODULE:FUNCTION.")
+    variants.add_argument('-g', '--group', help = "A function that takes a font's TeX name and returns a key, as MODULE:FUNCTION, so that only fonts with the same key share an .htf file.")
+    variants.add_argument('-o', '--output_dir', default = '.', help = 'The directory the .htf files are in.  The default is the current directory.')
+    variants.add_argument('-n', '--dry_run', action = 'store_true', help = 'Print the plan instead of changing the .htf files.')
+    variants.add_argument('-q', '--quiet', action = 'store_true', help = "Don't print non-error messages.")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(format = '%(message)s')
+    font_css = _import_function(args.css) if getattr(args, 'css', None) else None
+
+    active = enable_profiling() if args.profile or args.trace else None
+    try:
+        return _run_command(args, font_css)
+    finally:
+        if active:
+            disable_profiling()
+            if args.profile:
+                active.write_summary(args.profile)
+            if args.trace:
+                active.write_trace(args.trace)
+
+
+def _import_function(name):
+    """Imports a function named as MODULE:FUNCTION on the command line."""
+    import importlib
+    module, _, function = name.partition(':')
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    return getattr(importlib.import_module(module), function)
+
+
+def _run_command(args, font_css):
+    """Runs the subcommand main() parsed and returns the exit status."""
+    if args.command == 'batch':
+        fonts = []
+        for name in args.map_file:
+            fonts.extend(iter_map(name))
+        cache = CharacterCache(args.cache, args.cache_size * 2**20) if args.cache else None
+        index = HTFIndex(args.index) if args.index else None
+        results = write_htfs(fonts, args.output_dir, args.search_path, args.jobs, args.force,
+                             args.backend, cache, args.deduplicate, font_css, index)
+        if not args.quiet:
+            for result in results:
+                if result.alias:
+                    print('Generated ' + result.htf_file + ' as an alias to ' + result.alias)
+                elif not result.error:
+                    print('Generated ' + result.htf_file)
+            if cache:
+                print('Cache hits: ' + str(cache.hits) + ', misses: ' + str(cache.misses))
+        return 1 if any(result.error for result in results) else 0
+
+    if args.command == 'vf':
+        if args.map_index:
+            fonts = MapIndex(args.map_index)
+        else:
+            fonts = []
+            for name in args.map_file:
+                fonts.extend(iter_map(name))
+        cache = CharacterCache(args.cache, args.cache_size * 2**20) if args.cache else None
+        resolver = VFResolver(fonts, args.search_path, args.backend, cache)
+        index = HTFIndex(args.index) if args.index else None
+        written = (index.written() if index else {}) if args.deduplicate else None
+        status = 0
+        for vf_file in args.vf_file:
+            tex_name = os.path.splitext(os.path.basename(vf_file))[0]
+            htf_file = os.path.join(args.output_dir, tex_name + '.htf')
+            if not args.force and os.path.exists(htf_file):
+                logging.error(tex_name + ": didn't overwrite " + htf_file)
+                status = 1
+                continue
+            try:
+                chars = resolver.resolve(vf_file)
+            except (LookupError, OSError, ValueError) as error:
+                logging.error(tex_name + ': ' + str(error))
+                status = 1
+                continue
+            if not chars:
+                logging.error(tex_name + ': no characters at positions 0-255')
+                status = 1
+                continue
+            with open(htf_file, 'w') as htf:
+                alias = write_htf(chars, tex_name, htf,
+                                  index.written() if index and not args.deduplicate else written)
+                if font_css:
+                    variant_aliases([tex_name], font_css, htf)
+            if not args.quiet:
+                print('Generated ' + htf_file + (' as an alias to ' + alias if alias else ''))
+        return status
+
+    if args.command == 'rebuild':
+        fonts = []
+        for name in args.map_file:
+            fonts.extend(iter_map(name))
+        cache = CharacterCache(args.cache, args.cache_size * 2**20) if args.cache else None
+        result = rebuild(fonts, args.output_dir, args.search_path, args.vf_file, font_css,
+                         args.manifest, args.jobs, args.backend, cache)
+        if not args.quiet:
+            print('Regenerated ' + str(len(result.written)) + ', unchanged ' + str(len(result.unchanged))
+                  + ', deleted ' + str(len(result.deleted)) + ', failed ' + str(len(result.errors)))
+        return 1 if result.errors else 0
+
+    if args.command == 'serve':
+        fonts = []
+        for name in args.map_file:
+            fonts.extend(iter_map(name))
+        cache = CharacterCache(args.cache, args.cache_size * 2**20) if args.cache else None
+        import signal
+        # Build systems usually stop services with SIGTERM, and this
+        # way the socket is removed and the workers are stopped.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        with HTFService(fonts, args.search_path, args.backend, cache, font_css, args.output_dir,
+                        args.jobs) as service:
+            if args.socket:
+                if not args.quiet:
+                    print('Listening on ' + args.socket, file = sys.stderr)
+                try:
+                    service.serve_socket(args.socket)
+                except KeyboardInterrupt:
+                    pass
+            else:
+                service.serve(sys.stdin, sys.stdout)
+        return 0
+
+    if args.command == 'index':
+        index = HTFIndex(args.index)
+        for directory in args.directory:
+            read = index.scan(directory)
+            if not args.quiet:
+                print('Read ' + str(read) + ' .htf files in ' + directory)
+        index.save()
+        if not args.quiet:
+            print(str(len(index.files)) + ' files with ' + str(len(index.fingerprints)) + ' different character tables indexed')
+        return 0
+
+    if args.command == 'maps':
+        status = 0
+        with MapIndex(args.index) as index:
+            if args.map_file:
+                parsed = index.update(args.map_file)
+                if not args.quiet:
+                    print('Parsed ' + str(parsed) + ' map files, ' + str(len(index)) + ' fonts indexed')
+            for name in args.lookup:
+                entries = index.lookup(tex_name = name) or index.lookup(ps_name = name)
+                if not entries:
+                    logging.error(name + ': not in the index')
+                    status = 1
+                for path, entry in entries:
+                    print(path + ': ' + ' '.join(field for field in entry if field))
+        return status
+
+    if args.command == 'variants':
+        tex_names = []
+        for name in args.map_file:
+            tex_names.extend(font.tex_name for font in iter_map(name))
+        plan = plan_variants(tex_names, font_css, _import_function(args.group) if args.group else None)
+        if args.dry_run:
+            for base, variants in plan:
+                print(base + '.htf: ' + ' '.join(tex_name for tex_name, css in variants))
+            return 0
+        changed = write_variants(plan, args.output_dir)
+        if not args.quiet:
+            print('Planned ' + str(len(plan)) + ' .htf files for ' + str(len(set(tex_names)))
+                  + ' fonts, added htfcss lines to ' + str(len(changed)))
+        return 0 if len(changed) == sum(1 for group in plan if _htfcss_block(group.variants)) else 1
+
+    if args.command == 'validate':
+        known = HTFIndex(args.index).names if args.index else ()
+        results, checked = validate_htfs(args.htf_file, args.search_path, known)
+        for problems in results.values():
+            for problem in problems:
+                logging.error(problem)
+        if not args.quiet:
+            print('Checked ' + str(checked) + ' files, ' + str(len(results)) + ' with problems')
+        return 1 if results else 0
+
+
 if __name__ == '__main__':
-    file = 'DroidSerif-Regular-ot1.vf'
-    # file = 'extending_hardys_proof.dvi'
-
-    with open(file, 'rb') as f:
-        machine = VFtoHTF()
-        for x in VFProcessor(f):
-            print(x)
-            machine(x)
-        print(machine.chars)
-
-
-# # Command line handler
-# if __name__ == '__main__':
-#     import argparse
-#     parser = argparse.ArgumentParser(description = 'This script generates virtual hypertext font files for use with TeX4ht from PostScript Font Binary glyph files, font encoding files, and virtual font files.  When called with only font files or only font and encoding files, it outputs as many .htf files as given font files.  It assigns encoding files and output file names to font files in order, so any font files without encoding files must come after font files with encoding files.  When called with a virtual font file, it will attempt to construct one .htf file for the virtual font.  If also supplied with a map file, it will search the map file for the font names and files in the virtual font.  Otherwise, it will assume that fonts are in the same order as they are in the virtual font file.')
-#     # Some of these I can't open as file objects.  The glyph and
-#     # encoding files have to be passed to FontForge methods as file
-#     # names, I want the default name of the .htf file to depend on the
-#     # glyph or encoding file which I won't know until after parsing
-#     # the arguments.  I prefer to pass file names to parse_vf
-#     # parse_map because it makes them easier to use in other scripts.
-#     parser.add_argument('pfb_file', nargs = '+', help = 'The name(s) of PostScript Font Binary file(s).')
-#     parser.add_argument('-e', '--encoding_file', nargs = '+', help = 'The name(s) of font encoding file(s).')
-#     parser.add_argument('-vf', '--virtual_font_file', help = 'The name of a virtual font file.')
-#     parser.add_argument('-m', '--map_file', help = 'The name of a map file.')
-#     parser.add_argument('-o', '--output_file', nargs = '+', help = 'The name(s) of output virtual hypertext font file(s).  The default is the name of the virtual font file, the encoding file, and then the name of the pfb file, in order, with .vf, .enc, or .pfb respectively replaced with .htf.')
-#     parser.add_argument('-q', '--quiet', action = 'store_true', help = "Don't print non-error messages.")
-#     parser.add_argument('-f', '--force', action = 'store_true', help ='Overwrite existing files.')
-#     parser.add_argument('-V', '--version', action = 'version', version = '%(prog) 1.0.0', help = 'Print version information and exit.')
-#     args = parser.parse_args()
-
-    # Should probably replace these complicated conditionals with some
-    # kind of OO class structure that has different behavior.
-
-    # if args.virtual_font_file:
-    #     font_char_lists = []
-    #     out = vf.replace('.vf','.htf')
-        
-    #     # Use the map file to line up the encoding and font files
-    #     if args.map_file:
-            
-    #         # TODO: this is severely broken
-    #         fonts = []
-    #         for file in pfb:
-    #             fonts.append(fontforge.open(file))
-    #             if enc:
-    #                 encodings = []
-    #                 for file in enc:
-    #                     encodings.append(fontforge.loadEncodingFile(file))
-    #                 else:
-    #                     pass
-
-    # else:
-    #     # TODO: This is broken by 3.3 because map now truncates like zip does in 2.7
-    #     for font in map(None, args.pfb_file, args.encoding_file, args.output_file):
-    #         # Set the output file's name.
-    #         if font[2]:
-    #             out = font[2]
-    #         elif font[1]:
-    #             out = font[1].replace('.enc','.htf')
-    #         else:
-    #             out = font[0].replace('.pfb','.htf')
-
-    #         if not args.quiet:
-    #             print('Generating ' + out + ' using characters from ' + pfb)
-    #             if font[1]:
-    #                 print(' with the encoding from ' + font[1], end=' ')
-    #             print()
-
-    #         # Write to file
-    #         write_htf(out, get_characters(font[0], font[1]), args.force)
-
-
-    # # Don't overwrite an existing file unless specifically requested
-    # if not overwrite and os.path.exists(name):
-    #     print("Didn't overwrite " + name)
-    #     return
+    sys.exit(main())